@@ -0,0 +1,215 @@
+# bench_spider_quest.py
+# Times the book builder stage by stage so regressions show up as numbers.
+# Each stage runs in a fresh child process and reports wall time, CPU time and
+# that process's peak RSS. Results go out as JSON; --compare turns a previous
+# run into a regression gate.
+#
+# Usage:
+#   python bench_spider_quest.py --out bench.json
+#   python bench_spider_quest.py --books real,100 --compare bench.json --tolerance 0.15
+#   python bench_spider_quest.py --only art_ --profile profiles/
+
+import os, sys, io, json, time, platform, argparse, resource, tempfile, cProfile, contextlib, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import build_spider_quest as bsq
+from PIL import Image, ImageDraw
+
+ART_BOX = (0, 0, 1100, 2200)   # roughly the art panel of the 8.5x8.5 trim
+
+def synthetic_pages(n):
+    # n pages cycling through the real content, so text and art mix stay realistic.
+    return [(f"{t} #{k+1}", b) for k, (t, b) in zip(range(n), (bsq.PAGES * (n // len(bsq.PAGES) + 1)))]
+
+def _canvas(size=(ART_BOX[2], ART_BOX[3])):
+    img = Image.new("RGB", size, (255,255,255))
+    return ImageDraw.Draw(img)
+
+def _clear_caches():
+    for fn in (bsq._font_index, bsq.resolve_font, bsq.get_font, bsq.measure):
+        fn.cache_clear()
+
+# ---------- Stages ----------
+def stage_load_font():
+    _clear_caches()
+    for size in (140, 229, 89, 132, 216, 84):
+        bsq.load_font(size)
+        bsq.load_font(size, bold=True)
+
+def stage_layout():
+    font = bsq.load_font(140)
+    bsq.measure.cache_clear()
+    d = _canvas((10, 10))
+    for _, body in bsq.PAGES * 4:
+        bsq.wrap_text_by_width(d, body, font, 995)
+
+def stage_draw_paragraph():
+    font = bsq.load_font(140)
+    d = _canvas((1200, 2600))
+    for _, body in bsq.PAGES:
+        bsq.draw_paragraph(d, body, 0, 0, 995, font, line_gap=21)
+
+def art_stage(fn):
+    x0, y0, x1, y1 = ART_BOX
+    cx, cy = (x0+x1)//2, (y0+y1)//2
+    def run():
+        d = _canvas()
+        for _ in range(20):
+            if fn in (bsq.art_spider, bsq.art_spinnerets):
+                fn(d, cx, cy, 1.0)
+            elif fn is bsq.art_web:
+                fn(d, cx, cy, min(x1-x0, y1-y0)//2 - 20)
+            else:
+                fn(d, ART_BOX)
+    return run
+
+def dense_web_stage(arrays, rings=60, spokes=240):
+    # A dense web over a gradient: ImageDraw calls vs NumPy array passes.
+    def run():
+        d = _canvas()
+        for _ in range(5):
+            bsq.ART_PRIMITIVES["web"](d, ART_BOX, rings=rings, spokes=spokes,
+                                      background=[(255,250,230), (210,230,255)], arrays=arrays)
+    return run
+
+def supersample_stage(factor):
+    # Every page's art panel at 8x10, drawn straight or supersampled.
+    def run():
+        geo = bsq.page_geometry(bsq.TRIMS["8x10"])
+        d = _canvas(bsq.TRIMS["8x10"])
+        for idx, (title, body) in enumerate(bsq.PAGES, 1):
+            spec = bsq.describe_page(idx, title, body)
+            if factor > 1:
+                bsq.draw_supersampled(d, geo["art"], factor, lambda sd: bsq.draw_art(sd, geo["art"], spec.art))
+            else:
+                bsq.draw_art(d, geo["art"], spec.art)
+    return run
+
+def stage_draw_art_for_page():
+    d = _canvas()
+    for idx in range(1, len(bsq.PAGES) + 1):
+        bsq.draw_art_for_page(d, ART_BOX, idx)
+
+def book_stage(pages, size_px):
+    def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            bsq.build_books([(os.path.join(tmp, "book.pdf"), size_px)], cache_dir=None, pages=pages)
+    return run
+
+def stage_poster_page():
+    # One 24x36 in page end to end: strip rendering keeps peak RSS per strip.
+    spec = bsq.describe_page(1, *bsq.PAGES[0])
+    bsq._render_page_job((spec, bsq.TRIMS["24x36"], bsq.RenderOptions()))
+
+def stage_pdf_save():
+    # Encode + write only: one page raster reused for every page.
+    img = bsq.render_page(1, *bsq.PAGES[0], bsq.TRIMS["8p5x8p5"])
+    with tempfile.TemporaryDirectory() as tmp:
+        with bsq.PdfWriter(os.path.join(tmp, "book.pdf")) as pdf:
+            for _ in bsq.PAGES:
+                pdf.add_page(bsq.encode_page(img))
+
+def all_stages(books):
+    stages = {"load_font": stage_load_font, "wrap_text_by_width": stage_layout, "draw_paragraph": stage_draw_paragraph}
+    for name in sorted(n for n in dir(bsq) if n.startswith("art_")):
+        stages[name] = art_stage(getattr(bsq, name))
+    stages["art_web[dense,draw]"] = dense_web_stage(False)
+    if bsq.np is not None:
+        stages["art_web[dense,numpy]"] = dense_web_stage(True)
+    stages["art_web[dense500,draw]"] = dense_web_stage(False, 100, 500)
+    if bsq.np is not None:
+        stages["art_web[dense500,numpy]"] = dense_web_stage(True, 100, 500)
+    stages["draw_art_for_page"] = stage_draw_art_for_page
+    for factor in (1, 2, 3, 4):
+        stages[f"art_panel[ss={factor}]"] = supersample_stage(factor)
+    for book in books:
+        pages = bsq.PAGES if book == "real" else synthetic_pages(int(book))
+        label = "real" if book == "real" else f"{book}p"
+        for trim in ("8p5x8p5", "8x10"):
+            stages[f"make_book[{label},{trim}]"] = book_stage(pages, bsq.TRIMS[trim])
+    stages["poster_page"] = stage_poster_page
+    stages["pdf_save"] = stage_pdf_save
+    return stages
+
+# ---------- Harness ----------
+def _measure(name, books, repeat, profile_dir):
+    fn = all_stages(books)[name]
+    walls, cpus = [], []
+    prof = cProfile.Profile() if profile_dir else None
+    for _ in range(repeat):
+        t0, c0 = time.perf_counter(), time.process_time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if prof:
+                prof.runcall(fn)
+            else:
+                fn()
+        walls.append(time.perf_counter() - t0)
+        cpus.append(time.process_time() - c0)
+    if prof:
+        prof.dump_stats(os.path.join(profile_dir, name.replace("[", "_").replace("]", "").replace(",", "_") + ".prof"))
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+    return {"wall_s": min(walls), "cpu_s": min(cpus), "peak_rss_mb": round(rss_mb, 1), "repeat": repeat}
+
+def run_stage(name, books, repeat, profile_dir):
+    # A fresh process per stage keeps peak RSS attributable to that stage.
+    ctx = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        return pool.submit(_measure, name, books, repeat, profile_dir).result()
+
+def compare(results, baseline, tolerance):
+    # Stages slower than baseline * (1 + tolerance); stages missing from either run are skipped.
+    slow = []
+    for name, r in results.items():
+        b = baseline.get("results", {}).get(name)
+        if b and r["wall_s"] > b["wall_s"] * (1 + tolerance):
+            slow.append((name, b["wall_s"], r["wall_s"]))
+    return slow
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark the Spider Quest book builder.")
+    ap.add_argument("--books", type=lambda v: v.split(","), default=["real", "100", "1000"],
+                    help="books to build end to end: 'real' (PAGES) and/or synthetic page counts")
+    ap.add_argument("--only", default="", help="run only stages whose name contains this text")
+    ap.add_argument("--repeat", type=int, default=3, help="runs per stage; the fastest is reported (book stages run once)")
+    ap.add_argument("--out", help="write results as JSON here")
+    ap.add_argument("--compare", help="baseline JSON from a previous run")
+    ap.add_argument("--tolerance", type=float, default=0.10, help="allowed slowdown vs --compare (0.10 = 10%%)")
+    ap.add_argument("--profile", help="also dump cProfile stats per stage into this directory")
+    args = ap.parse_args()
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+
+    results = {}
+    for name in all_stages(args.books):
+        if args.only not in name:
+            continue
+        repeat = 1 if name.startswith("make_book") else args.repeat
+        r = results[name] = run_stage(name, args.books, repeat, args.profile)
+        print(f"{name:34s} wall {r['wall_s']*1000:10.1f} ms   cpu {r['cpu_s']*1000:10.1f} ms   rss {r['peak_rss_mb']:8.1f} MB")
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "pillow": Image.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "builder": bsq.BUILDER_VERSION,
+            "fonts": bsq.font_report(),
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Wrote", args.out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            slow = compare(results, json.load(f), args.tolerance)
+        for name, before, after in slow:
+            print(f"REGRESSION {name}: {before*1000:.1f} ms -> {after*1000:.1f} ms (+{(after/before - 1)*100:.0f}%)")
+        if slow:
+            sys.exit(1)
+        print(f"No stage slower than baseline by more than {args.tolerance:.0%}.")
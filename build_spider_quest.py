@@ -4,90 +4,537 @@
 #
 # Requirements: Pillow (PIL)
 #   pip install pillow
+#
+# Usage:
+#   python build_spider_quest.py            # single process
+#   python build_spider_quest.py --jobs 8   # render pages on 8 cores (0 = all)
+#   python build_spider_quest.py --no-cache # ignore .spider_cache and redraw everything
+#   python build_spider_quest.py --trims 8x10,A4,6x9
+#   python build_spider_quest.py --trims 24x36      # posters render in strips; memory stays per strip
+#   python build_spider_quest.py --encoding auto   # smallest of jpeg/flate/palette per page
+#   python build_spider_quest.py --batch manifests/   # every book manifest in one job
+#   python build_spider_quest.py --variants class.txt # a personalized copy per name; shared pages render once
+#   python build_spider_quest.py --derivatives     # + thumbnails, a 96 DPI screen edition, linearized PDFs
+#   python build_spider_quest.py --watch           # rebuild changed pages on every save
+#   python build_spider_quest.py --deterministic   # byte-reproducible PDFs, unchanged books left alone
+#   python build_spider_quest.py --backend vector  # tiny PDFs: paths + embedded text
+#   python build_spider_quest.py --trace trace.json   # per-stage spans (chrome://tracing)
+#   python build_spider_quest.py --font F.ttf --font-bold FB.ttf --strict-fonts
+
+from PIL import Image, ImageChops, ImageDraw, ImageFont, features
+import os, io, re, sys, csv, math, time, json, queue, types, random, zlib, struct, shutil, hashlib, inspect, functools, argparse, threading, traceback, subprocess, tracemalloc
+from collections import namedtuple, deque, Counter, OrderedDict
+from contextlib import ExitStack, contextmanager
 
-from PIL import Image, ImageDraw, ImageFont
-import os, math, textwrap
+try:
+    import pyphen   # optional: dictionary hyphenation for layout_text(hyphenate=True)
+except ImportError:
+    pyphen = None
+try:
+    from fontTools import subset as ft_subset   # optional: subset fonts embedded by --backend vector
+except ImportError:
+    ft_subset = None
+try:
+    import numpy as np   # optional: --art-backend numpy draws dense patterns as array passes
+except ImportError:
+    np = None
+try:
+    import pikepdf   # optional: linearize PDFs when the qpdf command is not installed
+except ImportError:
+    pikepdf = None
+from concurrent.futures import ProcessPoolExecutor
 
 ROOT = os.path.abspath(".")
 BOOKS_DIR = os.path.join(ROOT, "books")
+VARIANTS_DIR = os.path.join(ROOT, "personalized")
+CACHE_DIR = os.path.join(ROOT, ".spider_cache")
 os.makedirs(BOOKS_DIR, exist_ok=True)
 
 # ---------- Fonts ----------
+# Directories scanned (once per process) for font files. SPIDER_FONT_DIRS
+# (os.pathsep-separated) is searched first.
+FONT_DIRS = [p for p in os.environ.get("SPIDER_FONT_DIRS", "").split(os.pathsep) if p] + [
+    "/Library/Fonts",
+    "/System/Library/Fonts/Supplemental",
+    "/System/Library/Fonts",
+    os.path.expanduser("~/Library/Fonts"),
+    os.path.expanduser("~/.fonts"),
+    os.path.expanduser("~/.local/share/fonts"),
+    "/usr/share/fonts",
+    "/usr/local/share/fonts",
+    "C:/Windows/Fonts",
+]
+
+# Preferred files per weight, best first: the macOS fonts the books were
+# designed with, then the common metric-compatible Linux/Windows families.
+FONT_CANDIDATES = {
+    False: ["Arial.ttf", "Helvetica.ttc", "SFNS.ttf", "LiberationSans-Regular.ttf",
+            "arial.ttf", "NotoSans-Regular.ttf", "DejaVuSans.ttf", "FreeSans.ttf"],
+    True:  ["Arial Bold.ttf", "Helvetica.ttc", "SFNS.ttf", "LiberationSans-Bold.ttf",
+            "arialbd.ttf", "NotoSans-Bold.ttf", "DejaVuSans-Bold.ttf", "FreeSansBold.ttf"],
+}
+
+# Explicit font files per weight (--font/--font-bold, SPIDER_FONT/SPIDER_FONT_BOLD);
+# also how pool workers inherit the parent's resolution.
+FONT_OVERRIDES = {False: os.environ.get("SPIDER_FONT"), True: os.environ.get("SPIDER_FONT_BOLD")}
+
+@functools.lru_cache(maxsize=None)
+def _font_index():
+    index = {}
+    for root in FONT_DIRS:
+        for dirpath, _, files in os.walk(root):
+            for f in files:
+                index.setdefault(f.lower(), os.path.join(dirpath, f))
+    return index
+
+@functools.lru_cache(maxsize=None)
+def resolve_font(bold=False):
+    # Path of the font file used for this weight, or None for Pillow's built-in font.
+    if FONT_OVERRIDES.get(bold):
+        return FONT_OVERRIDES[bold]
+    index = _font_index()
+    for name in FONT_CANDIDATES[bold]:
+        path = index.get(name.lower())
+        if path:
+            return path
+    return None
+
+@functools.lru_cache(maxsize=64)
+def get_font(path, size):
+    return ImageFont.truetype(path, size)
+
+def font_report():
+    return {("bold" if bold else "regular"): resolve_font(bold) or "Pillow built-in font" for bold in (False, True)}
+
 def load_font(size, bold=False):
-    # Try common macOS fonts first, then fall back.
-    try_paths = [
-        ("/Library/Fonts/Arial Bold.ttf" if bold else "/Library/Fonts/Arial.ttf"),
-        ("/System/Library/Fonts/Supplemental/Arial Bold.ttf" if bold else "/System/Library/Fonts/Supplemental/Arial.ttf"),
-        ("/System/Library/Fonts/Supplemental/Helvetica.ttc"),
-        ("/System/Library/Fonts/SFNS.ttf"),
-    ]
-    for p in try_paths:
-        try:
-            return ImageFont.truetype(p, size)
-        except:
+    path = resolve_font(bold)
+    if path:
+        return get_font(path, size)
+    return ImageFont.load_default(size)
+
+# ---------- Text Layout ----------
+# Words are measured once per (font, token) and lines are built from summed
+# advances, so wrapping is linear in the number of words.
+SHY = "\u00ad"   # soft hyphen: invisible unless a line breaks there
+HYPHEN_LANG = "en_US"
+
+# One laid-out line: top-left corner, advance width and line height in px.
+LineBox = namedtuple("LineBox", "text x y width height")
+
+@functools.lru_cache(maxsize=65536)
+def measure(font, token):
+    return font.getlength(token)
+
+@functools.lru_cache(maxsize=None)
+def _hyphenator(lang):
+    return pyphen.Pyphen(lang=lang) if pyphen else None
+
+@functools.lru_cache(maxsize=16384)
+def hyphen_splits(word, lang=HYPHEN_LANG):
+    # (head, tail) pairs a word may break into, longest head first. Breaks at
+    # soft hyphens and existing hyphens/dashes, plus dictionary points when
+    # pyphen is installed.
+    clean = word.replace(SHY, "")
+    points, k = {}, 0
+    for ch in word:
+        if ch == SHY:
+            points[k] = "-"
+        else:
+            k += 1
+            if ch in "-\u2013\u2014" and 0 < k < len(clean):
+                points[k] = ""
+    hy = _hyphenator(lang)
+    if hy and clean.isalpha():
+        for pos in hy.positions(clean):
+            points.setdefault(pos, "-")
+    return tuple((clean[:pos] + points[pos], clean[pos:]) for pos in sorted(points, reverse=True))
+
+def layout_text(text, font, max_width, x=0, y=0, line_gap=0, align="left", hyphenate=False, min_last_words=1):
+    space = measure(font, " ")
+    lines, cur, cur_w = [], [], 0
+    words = text.split()
+    k = 0
+    while k < len(words):
+        word = words[k]
+        ww = measure(font, word.replace(SHY, ""))
+        if not cur or cur_w + space + ww <= max_width:
+            if cur:
+                cur_w += space
+            cur.append(word.replace(SHY, ""))
+            cur_w += ww
+            k += 1
             continue
-    return ImageFont.load_default()
+        if hyphenate:
+            for head, tail in hyphen_splits(word):
+                hw = measure(font, head)
+                if cur_w + space + hw <= max_width:
+                    cur.append(head)
+                    cur_w += space + hw
+                    words[k] = tail
+                    break
+        lines.append((cur, cur_w))
+        cur, cur_w = [], 0
+    if cur:
+        lines.append((cur, cur_w))
+
+    # Widow (runt) control: pull words down so the last line isn't a lone word.
+    if min_last_words > 1 and len(lines) > 1:
+        (prev, prev_w), (last, last_w) = lines[-2], lines[-1]
+        while len(last) < min_last_words and len(prev) > min_last_words:
+            mw = measure(font, prev[-1])
+            if last_w + space + mw > max_width:
+                break
+            last_w += space + mw
+            last = [prev.pop()] + last
+            prev_w -= space + mw
+        lines[-2:] = [(prev, prev_w), (last, last_w)]
+
+    lh = int(font.size*1.15)
+    boxes, cy = [], y
+    for words_, w in lines:
+        dx = {"left": 0, "center": (max_width - w) / 2, "right": max_width - w}[align]
+        boxes.append(LineBox(" ".join(words_), x + int(dx), cy, w, lh))
+        cy += lh + line_gap
+    return boxes
 
 # ---------- Drawing Helpers ----------
+def draw_lines(d, lines, font, fill):
+    for ln in lines:
+        d.text((ln.x, ln.y), ln.text, font=font, fill=fill)
+    return lines[-1].y + lines[-1].height if lines else None
+
 def draw_centered_text(d, text, box, font, fill):
     x0,y0,x1,y1 = box
-    w,h = d.textbbox((0,0), text, font=font)[2:]
-    cx = x0 + (x1-x0 - w)//2
-    cy = y0 + (y1-y0 - h)//2
-    d.text((cx, cy), text, font=font, fill=fill)
+    lines = layout_text(text, font, x1-x0, x=x0, align="center")
+    block_h = lines[-1].y + lines[-1].height - lines[0].y if lines else 0
+    dy = (y1-y0 - block_h)//2
+    draw_lines(d, [ln._replace(y=ln.y + y0 + dy) for ln in lines], font, fill)
 
 def wrap_text_by_width(d, text, font, max_width_px):
-    words = text.split()
-    lines, cur = [], ""
-    for w in words:
-        test = (cur + " " + w).strip()
-        if d.textlength(test, font=font) <= max_width_px:
-            cur = test
-        else:
-            if cur: lines.append(cur)
-            cur = w
-    if cur: lines.append(cur)
-    return lines
+    return [ln.text for ln in layout_text(text, font, max_width_px)]
 
-def draw_paragraph(d, text, x, y, width, font, line_gap=0, fill=(30,30,30)):
-    lines = wrap_text_by_width(d, text, font, width)
-    lh = int(font.size*1.15)
-    cy = y
-    for ln in lines:
-        d.text((x, cy), ln, font=font, fill=fill)
-        cy += lh + line_gap
-    return cy
+def draw_paragraph(d, text, x, y, width, font, line_gap=0, fill=(30,30,30), hyphenate=False, min_last_words=1):
+    lines = layout_text(text, font, width, x=x, y=y, line_gap=line_gap, hyphenate=hyphenate, min_last_words=min_last_words)
+    draw_lines(d, lines, font, fill)
+    return y + len(lines) * (int(font.size*1.15) + line_gap)
+
+# ---------- Sprites ----------
+# Repeated illustrations are drawn once per (function, params, sub-pixel
+# phase) into an RGBA tile and pasted. Pillow doesn't anti-alias these
+# primitives, so a pasted tile matches drawing in place pixel for pixel.
+SPRITE_CACHE_BYTES = 64 * 1024 * 1024
+
+class SpriteCache:
+    # LRU of RGBA tiles bounded by total pixel bytes.
+    def __init__(self, max_bytes=SPRITE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = 0
+
+    def get(self, key, render):
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+        self.misses += 1
+        tile = render()
+        size = tile[0].width * tile[0].height * 4
+        if size <= self.max_bytes:
+            self.tiles[key] = tile
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (old, _) = self.tiles.popitem(last=False)
+                self.bytes -= old.width * old.height * 4
+        return tile
+
+    def clear(self):
+        self.tiles.clear()
+        self.bytes = 0
+
+SPRITES = SpriteCache()
+
+# ---------- Page Buffers ----------
+# Page canvases, strips and supersampling bands are large (Pillow keeps RGB
+# at 4 bytes a pixel: ~29 MB for an 8x10 page), and a fresh one costs more
+# than clearing a used one, because its memory comes back from the OS one
+# zeroed page at a time. Each process keeps the images its stages are done
+# with and hands them out again, cleared, for the next one of that size.
+CANVAS_POOL_BYTES = 128 * 1024 * 1024
+
+class CanvasPool:
+    # Released images by (mode, size), bounded by total pixel bytes.
+    def __init__(self, max_bytes=CANVAS_POOL_BYTES):
+        self.max_bytes = max_bytes
+        self.free = {}
+        self.bytes = 0
+        self.hits = self.misses = 0
+
+    def acquire(self, mode, size, color=0):
+        # Like Image.new(mode, size, color); color=None leaves old pixels
+        # in place for callers that overwrite all of them.
+        stack = self.free.get((mode, size))
+        if not stack:
+            self.misses += 1
+            return Image.new(mode, size, color)
+        self.hits += 1
+        img = stack.pop()
+        self.bytes -= img.width * img.height * 4
+        if color is not None:
+            img.paste(color, (0, 0) + size)
+        return img
+
+    def release(self, img):
+        # Hands img back; the caller (and anything it gave img to) must be
+        # done with it.
+        size = img.width * img.height * 4
+        if self.bytes + size <= self.max_bytes:
+            self.free.setdefault((img.mode, img.size), []).append(img)
+            self.bytes += size
+
+    def clear(self):
+        self.free.clear()
+        self.bytes = 0
+
+CANVASES = CanvasPool()
+
+def raster_target(d):
+    # (image, (dx, dy)) that d draws into, or None for non-raster surfaces
+    # (and for supersampled ones, which aren't in page pixels).
+    if isinstance(d, OffsetDraw):
+        if d.scale != 1:
+            return None
+        target = raster_target(d.d)
+        return target and (target[0], (target[1][0] + d.dx, target[1][1] + d.dy))
+    im = getattr(d, "_image", None)
+    return (im, (0, 0)) if im is not None else None
+
+class _BBox:
+    # Stand-in surface that only records how far the drawing calls reach.
+    def __init__(self):
+        self.box = [math.inf, math.inf, -math.inf, -math.inf]
+
+    def _add(self, xy, width=0):
+        pts = xy if isinstance(xy[0], (tuple, list)) else list(zip(xy[0::2], xy[1::2]))
+        for x, y in pts:
+            self.box = [min(self.box[0], x - width), min(self.box[1], y - width),
+                        max(self.box[2], x + width), max(self.box[3], y + width)]
+
+    def ellipse(self, xy, fill=None, outline=None, width=1):
+        self._add(xy)
+
+    rectangle = ellipse
+
+    def arc(self, xy, start, end, fill=None, width=1):
+        self._add(xy)
+
+    def line(self, xy, fill=None, width=0):
+        self._add(xy, width)
+
+    def polygon(self, xy, fill=None, outline=None, width=1):
+        self._add(xy, width)
+
+def draw_sprite(d, fn, cx, cy, *params):
+    # fn(d, cx, cy, *params) drawn via the sprite cache on raster surfaces.
+    target = raster_target(d)
+    if target is None:
+        return fn(d, cx, cy, *params)
+    im, (dx, dy) = target
+    ix, iy = math.floor(cx), math.floor(cy)
+    fx, fy = cx - ix, cy - iy
+
+    def render():
+        rec = _BBox()
+        fn(rec, fx, fy, *params)
+        ox, oy = math.floor(rec.box[0]) - 2, math.floor(rec.box[1]) - 2
+        tile = Image.new("RGBA", (math.ceil(rec.box[2]) - ox + 3, math.ceil(rec.box[3]) - oy + 3), (0,0,0,0))
+        fn(ImageDraw.Draw(tile), fx - ox, fy - oy, *params)
+        return tile, (ox, oy)
+
+    tile, (ox, oy) = SPRITES.get((fn.__name__, params, fx, fy), render)
+    im.paste(tile, (ix + ox + dx, iy + oy + dy), tile)
+
+# ---------- Array Art (NumPy) ----------
+# Dense procedural patterns computed in one array pass over their bounding
+# box and composited into the page through a coverage mask (so edges come
+# out anti-aliased), instead of one ImageDraw call per ring, spoke or petal.
+# Used by primitives given arrays=True (RenderOptions.art_backend "numpy").
+def use_arrays(d, arrays):
+    return bool(arrays) and np is not None and raster_target(d) is not None
+
+def _region(d, box):
+    # Image, the part of box it covers (image coords) and page-coord grids
+    # (column vector ys, row vector xs) for it; None if box is off the image.
+    im, (dx, dy) = raster_target(d)
+    x0, y0 = max(math.floor(box[0]) + dx, 0), max(math.floor(box[1]) + dy, 0)
+    x1, y1 = min(math.ceil(box[2]) + dx + 1, im.width), min(math.ceil(box[3]) + dy + 1, im.height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    ys = np.arange(y0 - dy, y1 - dy, dtype=np.float32)[:, None]
+    xs = np.arange(x0 - dx, x1 - dx, dtype=np.float32)[None, :]
+    return im, (x0, y0, x1, y1), ys, xs
+
+def _stroke(dist, width):
+    # Coverage (0..1) of a stroke width px wide at distance dist from its centre line.
+    return np.clip(width / 2 + 0.5 - dist, 0, 1)
+
+def _composite(im, region, color, cov):
+    im.paste(tuple(color), region, Image.fromarray((cov * 255 + 0.5).astype(np.uint8), "L"))
+
+WEB_FIELD_SUB = 64   # distance-table steps per px
+
+@functools.lru_cache(maxsize=4)   # ~15 MB each for a full-page web
+def _web_fields(h, w, ox, oy, r):
+    # Per-pixel fields for a web whose centre is (-ox, -oy) from the top-left
+    # pixel of an h x w region: distance (px), angle (turns), distance as a
+    # table index (and its largest value), and 255 inside the rim / 0 outside. They depend only on
+    # where the web sits in the region, so every web drawn at the same size
+    # and offset (same page, trim and strip) reuses them.
+    ys = np.arange(h, dtype=np.float32)[:, None] + np.float32(oy)
+    xs = np.arange(w, dtype=np.float32)[None, :] + np.float32(ox)
+    dist = np.sqrt(xs*xs + ys*ys)
+    turn = np.arctan2(ys, xs)
+    turn *= np.float32(1 / (2*math.pi))
+    index = np.rint(dist * WEB_FIELD_SUB).astype(np.int32)
+    inside = np.where(dist <= r, np.uint8(255), np.uint8(0))
+    return dist, turn, index, int(index.max()), inside
+
+def np_web(d, cx, cy, r, rings=5, spokes=12, color=(255,140,0)):
+    # Rings and rim depend only on the distance from the centre, so they come
+    # from a table over distance looked up once per pixel; spokes from the
+    # angle to the nearest spoke. A fixed number of passes over the web's box
+    # however many rings and spokes there are, on cached fields. Coverage is
+    # that of the nearest stroke (the 6 px rim counts 1.5 px closer than the
+    # 3 px lines).
+    reg = _region(d, (cx-r-4, cy-r-4, cx+r+4, cy+r+4))
+    if reg is None:
+        return
+    im, region, ys, xs = reg
+    dist, turn, index, top, inside = _web_fields(ys.shape[0], xs.shape[1], float(xs[0, 0] - cx), float(ys[0, 0] - cy), r)
+    # rings + rim, as a table over distance
+    dt = np.arange(top + 1, dtype=np.float32) / WEB_FIELD_SUB
+    near = np.full(dt.shape, np.inf, np.float32)
+    if rings > 1:
+        step = r / rings
+        near = np.abs(np.clip(np.round(dt / step), 1, rings - 1) * step - dt)
+    near[dt > r] = np.inf
+    np.minimum(near, np.abs(dt - r) - 1.5, out=near)
+    cov = np.take((_stroke(near, 3) * 255 + 0.5).astype(np.uint8), index)
+    if spokes > 0:
+        # Angle to the nearest spoke (in spokes) times the arc per spoke at
+        # this radius: the distance to that spoke wherever one is close
+        # enough to matter (sin x ~ x there). Turned straight into 0..255
+        # coverage of a 3 px stroke.
+        a = turn * np.float32(spokes)
+        a -= np.rint(a)
+        np.abs(a, out=a)
+        a *= dist
+        a *= np.float32(-255 * 2*math.pi / spokes)
+        a += np.float32(255 * 2 + 0.5)
+        np.clip(a, 0, 255, out=a)
+        s = a.astype(np.uint8)
+        np.minimum(s, inside, out=s)
+        np.maximum(cov, s, out=cov)
+    im.paste(tuple(color), region, Image.fromarray(cov, "L"))
+
+def np_discs(d, centers, radius, color):
+    # Filled circles of one radius: distance to the nearest centre.
+    xs_c = [x for x, _ in centers]
+    ys_c = [y for _, y in centers]
+    reg = _region(d, (min(xs_c)-radius, min(ys_c)-radius, max(xs_c)+radius, max(ys_c)+radius))
+    if reg is None:
+        return
+    im, region, ys, xs = reg
+    c = np.asarray(centers, dtype=np.float32)
+    dist = np.sqrt(((xs[None] - c[:, 0, None, None])**2 + (ys[None] - c[:, 1, None, None])**2).min(axis=0))
+    _composite(im, region, color, np.clip(radius + 0.5 - dist, 0, 1))
+
+def np_hlines(d, box, start, stop, step, color, width=3):
+    # Horizontal lines at y = start, start+step, ... < stop, spanning box's x range.
+    reg = _region(d, (box[0], start - width, box[2], stop + width))
+    if reg is None:
+        return
+    im, region, ys, xs = reg
+    rel = ys - start
+    off = np.abs((rel + step/2) % step - step/2)
+    last = start + ((stop - 1 - start) // step) * step
+    cov = ((off <= width // 2) & (ys >= start - width) & (ys <= last + width)) & ((xs >= box[0]) & (xs <= box[2]))
+    _composite(im, region, color, cov.astype(np.float32))
+
+def np_gradient(d, box, top, bottom):
+    # Vertical gradient filling box: one array op for every row at once.
+    reg = _region(d, (box[0], box[1], box[2] - 1, box[3] - 1))
+    if reg is None:
+        return
+    im, (x0, y0, x1, y1), ys, xs = reg
+    t = np.clip((ys - box[1]) / max(box[3] - box[1] - 1, 1), 0, 1)[:, :, None]
+    column = np.asarray(top, np.float32) * (1 - t) + np.asarray(bottom, np.float32) * t
+    # one pixel wide, then stretched: every row is a single colour
+    im.paste(Image.fromarray((column + 0.5).astype(np.uint8), "RGB").resize((x1 - x0, y1 - y0), Image.NEAREST), (x0, y0))
+
+def draw_gradient(d, box, top, bottom, arrays=False):
+    if use_arrays(d, arrays):
+        return np_gradient(d, box, top, bottom)
+    h = max(box[3] - box[1] - 1, 1)
+    for y in range(box[1], box[3]):
+        t = (y - box[1]) / h
+        d.line((box[0], y, box[2] - 1, y), fill=tuple(round(a*(1-t) + b*t) for a, b in zip(top, bottom)))
+
+# ---------- Shape Geometry ----------
+# Trig and scaled offsets the illustrations reuse on every page, worked out
+# once per shape and size. Each is the same arithmetic the drawing used to
+# do inline, so pages come out pixel-identical.
+@functools.lru_cache(maxsize=None)
+def _spokes(n):
+    # Unit vectors for n evenly spaced spokes, the first pointing right.
+    return tuple((math.cos(2*math.pi*s/n), math.sin(2*math.pi*s/n)) for s in range(n))
+
+@functools.lru_cache(maxsize=None)
+def _petals(radius, step):
+    # Integer offsets of petal centres every step degrees around a flower.
+    return tuple((int(radius*math.cos(math.radians(ang))), int(radius*math.sin(math.radians(ang))))
+                 for ang in range(0, 360, step))
+
+SpiderGeometry = namedtuple("SpiderGeometry", "body_r er eye_dx eye_dy leg_len leg_width leg_dy leg_rise")
+
+@functools.lru_cache(maxsize=256)
+def _spider_geometry(scale):
+    return SpiderGeometry(int(60*scale), int(12*scale), 24*scale, 10*scale, int(100*scale), int(8*scale),
+                          30*scale, 20*scale)
 
 # ---------- Simple Illustrations (cute, high-contrast) ----------
-def art_spider(d, cx, cy, scale=1.0):
+def art_spider(d, cx, cy, scale=1.0, color=(60,60,60)):
+    draw_sprite(d, _draw_spider, cx, cy, scale, tuple(color))
+
+def _draw_spider(d, cx, cy, scale=1.0, color=(60,60,60)):
+    g = _spider_geometry(scale)
     # body
-    body_r = int(60*scale)
-    d.ellipse((cx-body_r, cy-body_r, cx+body_r, cy+body_r), fill=(60,60,60))
+    body_r, er = g.body_r, g.er
+    d.ellipse((cx-body_r, cy-body_r, cx+body_r, cy+body_r), fill=color)
     # eyes
-    er = int(12*scale)
-    d.ellipse((cx-24*scale-er, cy-10*scale-er, cx-24*scale+er, cy-10*scale+er), fill=(255,255,255))
-    d.ellipse((cx+24*scale-er, cy-10*scale-er, cx+24*scale+er, cy-10*scale+er), fill=(255,255,255))
-    d.ellipse((cx-24*scale-4, cy-10*scale-2, cx-24*scale+2, cy-10*scale+4), fill=(0,0,0))
-    d.ellipse((cx+24*scale-4, cy-10*scale-2, cx+24*scale+2, cy-10*scale+4), fill=(0,0,0))
+    ex, ey = g.eye_dx, g.eye_dy
+    d.ellipse((cx-ex-er, cy-ey-er, cx-ex+er, cy-ey+er), fill=(255,255,255))
+    d.ellipse((cx+ex-er, cy-ey-er, cx+ex+er, cy-ey+er), fill=(255,255,255))
+    d.ellipse((cx-ex-4, cy-ey-2, cx-ex+2, cy-ey+4), fill=(0,0,0))
+    d.ellipse((cx+ex-4, cy-ey-2, cx+ex+2, cy-ey+4), fill=(0,0,0))
     # legs
-    leg_len = int(100*scale)
     for i in range(4):
         # left
-        y = cy - 30*scale + i*20*scale
-        d.line((cx- body_r, y, cx- body_r - leg_len, y - 20*scale), fill=(60,60,60), width=int(8*scale))
+        y = cy - g.leg_dy + i*20*scale
+        d.line((cx- body_r, y, cx- body_r - g.leg_len, y - g.leg_rise), fill=color, width=g.leg_width)
         # right
-        d.line((cx+ body_r, y, cx+ body_r + leg_len, y - 20*scale), fill=(60,60,60), width=int(8*scale))
+        d.line((cx+ body_r, y, cx+ body_r + g.leg_len, y - g.leg_rise), fill=color, width=g.leg_width)
 
-def art_web(d, cx, cy, r, rings=5, spokes=12, color=(255,140,0)):
+def art_web(d, cx, cy, r, rings=5, spokes=12, color=(255,140,0), arrays=False):
+    if use_arrays(d, arrays):
+        return np_web(d, cx, cy, r, rings, spokes, color)
     d.ellipse((cx-r, cy-r, cx+r, cy+r), outline=color, width=6)
     for k in range(1, rings):
         rr = int(r*k/rings)
         d.ellipse((cx-rr, cy-rr, cx+rr, cy+rr), outline=color, width=3)
-    for s in range(spokes):
-        ang = 2*math.pi*s/spokes
-        x = cx + int(r*math.cos(ang))
-        y = cy + int(r*math.sin(ang))
-        d.line((cx, cy, x, y), fill=color, width=3)
+    for ux, uy in _spokes(spokes):
+        d.line((cx, cy, cx + int(r*ux), cy + int(r*uy)), fill=color, width=3)
 
 def art_world(d, box):
     x0,y0,x1,y1 = box
@@ -101,16 +548,16 @@ def art_world(d, box):
     # Antarctica "brr!"
     d.arc((cx-r, cy-r, cx+r, cy+r), 180, 360, fill=(255,255,255), width=10)
 
-def art_bug_scene(d, box):
+def art_bug_scene(d, box, rng=None):
+    rng = rng or random
     x0,y0,x1,y1 = box
     # background panel
     d.rectangle(box, fill=(255,240,246))
     # draw a bunch of bugs (good/avoid)
-    import random
     for _ in range(12):
-        x = random.randint(x0+20, x1-20)
-        y = random.randint(y0+20, y1-20)
-        good = random.random() < 0.7
+        x = rng.randint(x0+20, x1-20)
+        y = rng.randint(y0+20, y1-20)
+        good = rng.random() < 0.7
         color = (85,239,196) if good else (253,121,168)
         d.ellipse((x-14, y-14, x+14, y+14), fill=color)
         # eyes
@@ -147,16 +594,17 @@ def art_size_compare(d, box):
     d.ellipse((x1-120-6, y0+130-6, x1-120+6, y0+130+6), fill=(255,99,132))
     art_spider(d, x1-120, y0+160, scale=0.25)
 
-def art_camouflage(d, box):
+def art_camouflage(d, box, arrays=False):
     x0,y0,x1,y1 = box
     d.rectangle(box, fill=(245,255,245))
     # flower
     cx = x0 + (x1-x0)//4; cy = y0 + (y1-y0)//2
-    for ang in range(0,360,30):
-        r=80
-        x=cx+int(r*math.cos(math.radians(ang)))
-        y=cy+int(r*math.sin(math.radians(ang)))
-        d.ellipse((x-30,y-30,x+30,y+30), fill=(255,200,210))
+    petals = [(cx+px, cy+py) for px, py in _petals(80, 30)]
+    if use_arrays(d, arrays):
+        np_discs(d, petals, 30, (255,200,210))
+    else:
+        for x, y in petals:
+            d.ellipse((x-30,y-30,x+30,y+30), fill=(255,200,210))
     d.ellipse((cx-25,cy-25,cx+25,cy+25), fill=(255,220,120))
     # crab spider blended as petal
     art_spider(d, cx+10, cy-10, scale=0.35)
@@ -176,7 +624,7 @@ def art_quiz_show(d, box):
     # host
     art_spider(d, x0+ (x1-x0)//2, y0+140, scale=0.6)
 
-def art_web_types(d, box):
+def art_web_types(d, box, arrays=False):
     x0,y0,x1,y1 = box
     w = (x1-x0)//3 - 20
     h = (y1-y0) - 20
@@ -191,7 +639,7 @@ def art_web_types(d, box):
     # orb
     bx = panels[0]
     cx = (bx[0]+bx[2])//2; cy = (bx[1]+bx[3])//2
-    art_web(d, cx, cy, min(bx[2]-bx[0], bx[3]-bx[1])//2 - 16, 5, 10, color=(0,150,220))
+    art_web(d, cx, cy, min(bx[2]-bx[0], bx[3]-bx[1])//2 - 16, 5, 10, color=(0,150,220), arrays=arrays)
     # funnel
     bx = panels[1]
     d.rectangle(bx, outline=(200,140,0), width=6)
@@ -199,40 +647,74 @@ def art_web_types(d, box):
     # sheet
     bx = panels[2]
     d.rectangle(bx, outline=(120,180,120), width=6)
-    for y in range(bx[1]+20, bx[3]-10, 16):
-        d.line((bx[0]+20, y, bx[2]-20, y), fill=(120,180,120), width=3)
+    if use_arrays(d, arrays):
+        np_hlines(d, (bx[0]+20, 0, bx[2]-20, 0), bx[1]+20, bx[3]-10, 16, (120,180,120))
+    else:
+        for y in range(bx[1]+20, bx[3]-10, 16):
+            d.line((bx[0]+20, y, bx[2]-20, y), fill=(120,180,120), width=3)
+
+# ---------- Art Primitives ----------
+# Name -> drawing call on the art box, filled in by @register_art as the
+# module loads. These are what manifests (and PAGE_ART below) refer to;
+# every keyword is an optional parameter.
+ART_PRIMITIVES = {}
+
+def register_art(name):
+    def register(fn):
+        ART_PRIMITIVES[name] = fn
+        return fn
+    return register
+
+def _center(box, dx=0, dy=0):
+    return (box[0]+box[2])//2 + dx, (box[1]+box[3])//2 + dy
+
+def _fit_radius(box):
+    return min(box[2]-box[0], box[3]-box[1])//2 - 20
+
+@register_art("spider")
+def _spider(d, box, scale=1.0, dx=0, dy=0, color=(60,60,60)):
+    art_spider(d, *_center(box, dx, dy), scale, tuple(color))
+
+@register_art("web")
+def _web(d, box, r=None, dx=0, dy=0, rings=5, spokes=12, color=(255,140,0), background=None, arrays=False):
+    # background: [top color, bottom color] gradient behind the web
+    if background:
+        draw_gradient(d, box, *map(tuple, background), arrays=arrays)
+    art_web(d, *_center(box, dx, dy), _fit_radius(box) if r is None else r, rings, spokes, tuple(color), arrays)
+
+@register_art("spinnerets")
+def _spinnerets(d, box, scale=1.0, dx=0, dy=0):
+    art_spinnerets(d, *_center(box, dx, dy), scale)
+
+# The box-filling illustrations take the box as it is.
+register_art("world")(art_world)
+register_art("bug_scene")(art_bug_scene)
+register_art("baby_ballooning")(art_baby_ballooning)
+register_art("size_compare")(art_size_compare)
+register_art("camouflage")(art_camouflage)
+register_art("quiz_show")(art_quiz_show)
+register_art("web_types")(art_web_types)
+
+# default: friendly spider
+DEFAULT_ART = {"type": "spider"}
+
+@functools.lru_cache(maxsize=None)
+def _accepts(fn):
+    return frozenset(inspect.signature(fn).parameters)
+
+def draw_art(d, box, art, rng=None, arrays=False):
+    # rng: random.Random for primitives that scatter things (see page_rng)
+    # arrays: let primitives that can, draw with NumPy (see Array Art)
+    fn = ART_PRIMITIVES[art["type"]]
+    params = {k: v for k, v in art.items() if k != "type"}
+    if rng is not None and "rng" in _accepts(fn):
+        params["rng"] = rng
+    if arrays and "arrays" in _accepts(fn):
+        params["arrays"] = True
+    fn(d, box, **params)
 
-# Map page index -> art function
 def draw_art_for_page(d, box, idx):
-    # default: friendly spider
-    mapping = {
-        1: lambda: (art_web(d, (box[0]+box[2])//2, (box[1]+box[3])//2, min(box[2]-box[0], box[3]-box[1])//2 - 20, color=(255,140,0))),
-        2: lambda: art_spider(d, (box[0]+box[2])//2, (box[1]+box[3])//2, 1.0),
-        3: lambda: art_spider(d, (box[0]+box[2])//2, (box[1]+box[3])//2, 1.0),
-        4: lambda: art_spider(d, (box[0]+box[2])//2, (box[1]+box[3])//2, 1.1),
-        5: lambda: art_spinnerets(d, (box[0]+box[2])//2, (box[1]+box[3])//2, 1.0),
-        6: lambda: art_web_types(d, box),
-        7: lambda: art_spider(d, (box[0]+box[2])//2, (box[1]+box[3])//2 - 40, 0.8),
-        8: lambda: art_spider(d, (box[0]+box[2])//2, (box[1]+box[3])//2, 1.2),
-        9: lambda: art_spider(d, (box[0]+box[2])//2, (box[1]+box[3])//2, 1.0),
-        10: lambda: art_spider(d, (box[0]+box[2])//2 - 80, (box[1]+box[3])//2, 0.7),
-        11: lambda: art_spider(d, (box[0]+box[2])//2, (box[1]+box[3])//2, 1.0),
-        12: lambda: art_spider(d, (box[0]+box[2])//2 - 120, (box[1]+box[3])//2, 0.7),
-        13: lambda: art_web(d, (box[0]+box[2])//2, (box[1]+box[3])//2, min(box[2]-box[0], box[3]-box[1])//2 - 20, color=(0,120,200)),
-        14: lambda: art_web(d, (box[0]+box[2])//2 - 60, (box[1]+box[3])//2, 120, color=(200,160,60)),
-        15: lambda: art_spider(d, (box[0]+box[2])//2 + 40, (box[1]+box[3])//2, 0.9),
-        16: lambda: art_baby_ballooning(d, box),
-        17: lambda: art_bug_scene(d, box),
-        18: lambda: art_size_compare(d, box),
-        19: lambda: art_camouflage(d, box),
-        20: lambda: art_spider(d, (box[0]+box[2])//2, (box[1]+box[3])//2, 1.0),
-        21: lambda: art_world(d, box),
-        22: lambda: art_spider(d, (box[0]+box[2])//2, (box[1]+box[3])//2, 0.9),
-        23: lambda: art_spider(d, (box[0]+box[2])//2, (box[1]+box[3])//2, 1.0),
-        24: lambda: art_quiz_show(d, box),
-        25: lambda: art_web(d, (box[0]+box[2])//2, (box[1]+box[3])//2, min(box[2]-box[0], box[3]-box[1])//2 - 20, color=(255,200,60)),
-    }
-    (mapping.get(idx) or (lambda: art_spider(d, (box[0]+box[2])//2, (box[1]+box[3])//2, 1.0)))()
+    draw_art(d, box, PAGE_ART.get(idx, DEFAULT_ART))
 
 # ---------- Book Content (same topics; friendlier, shorter body lines) ----------
 PAGES = [
@@ -263,55 +745,1821 @@ PAGES = [
     ("The End", "Small creatures, big jobs. You’re a spider expert now!")
 ]
 
+# Page index -> art for PAGES (anything missing gets DEFAULT_ART)
+PAGE_ART = {
+    1: {"type": "web", "color": (255,140,0)},
+    2: {"type": "spider"},
+    3: {"type": "spider"},
+    4: {"type": "spider", "scale": 1.1},
+    5: {"type": "spinnerets"},
+    6: {"type": "web_types"},
+    7: {"type": "spider", "dy": -40, "scale": 0.8},
+    8: {"type": "spider", "scale": 1.2},
+    9: {"type": "spider"},
+    10: {"type": "spider", "dx": -80, "scale": 0.7},
+    11: {"type": "spider"},
+    12: {"type": "spider", "dx": -120, "scale": 0.7},
+    13: {"type": "web", "color": (0,120,200)},
+    14: {"type": "web", "dx": -60, "r": 120, "color": (200,160,60)},
+    15: {"type": "spider", "dx": 40, "scale": 0.9},
+    16: {"type": "baby_ballooning"},
+    17: {"type": "bug_scene"},
+    18: {"type": "size_compare"},
+    19: {"type": "camouflage"},
+    20: {"type": "spider"},
+    21: {"type": "world"},
+    22: {"type": "spider", "scale": 0.9},
+    23: {"type": "spider"},
+    24: {"type": "quiz_show"},
+    25: {"type": "web", "color": (255,200,60)},
+}
+
+# Page index -> (title, body) replacing PAGES in personalized copies (see
+# Personalized Variants); {field}s are filled in per reader.
+PERSONAL_PAGES = {
+    1: ("Cover", "Spiders! Eight Legs of Awesome.\nTagline: Eight legs. Endless surprises.\nThis book belongs to {name}."),
+    25: ("The End", "Small creatures, big jobs. {name}, you’re a spider expert now!"),
+}
+
+# ---------- Manifests ----------
+# A book as data: JSON, TOML or YAML (YAML needs PyYAML), e.g.
+#   {"title": "Spiders! Eight Legs of Awesome",
+#    "output": "Spiders_Eight_Legs_of_Awesome",      # file stem, "_<trim>.pdf" is appended
+#    "trims": ["8p5x8p5", "8x10"],                    # TRIMS names, or {"name": [W, H]}
+#    "pages": [{"title": "...", "body": "...", "art": {"type": "web", "color": [255,140,0]}}]}
+# Pages without "art" get DEFAULT_ART. Art parameters are the primitive's
+# keyword arguments; the common ones are checked against ART_PARAMS.
+MANIFEST_EXTS = (".json", ".toml", ".yaml", ".yml")
+
+def _number(lo, hi, integer=False):
+    def check(v):
+        return isinstance(v, int if integer else (int, float)) and not isinstance(v, bool) and lo <= v <= hi
+    return check
+
+def _color(v):
+    return isinstance(v, (list, tuple)) and len(v) == 3 and all(_number(0, 255, integer=True)(c) for c in v)
+
+# Art parameter name -> (check, what it takes). rng and arrays are the
+# builder's (see draw_art), not the manifest's.
+ART_PARAMS = {
+    "scale": (_number(0.01, 10), "a number from 0.01 to 10"),
+    "dx": (_number(-10000, 10000), "a number from -10000 to 10000"),
+    "dy": (_number(-10000, 10000), "a number from -10000 to 10000"),
+    "r": (_number(1, 10000), "a number from 1 to 10000"),
+    "rings": (_number(1, 10000, integer=True), "a whole number from 1 to 10000"),
+    "spokes": (_number(1, 10000, integer=True), "a whole number from 1 to 10000"),
+    "color": (_color, "[R, G, B] with 0-255 each"),
+    "background": (lambda v: isinstance(v, (list, tuple)) and len(v) == 2 and all(map(_color, v)),
+                   "[[R, G, B], [R, G, B]] (top, bottom)"),
+}
+BUILDER_ART_PARAMS = ("rng", "arrays")
+
+Book = namedtuple("Book", "title output trims pages")   # pages: [(title, body, art), ...]
+
+def builtin_book():
+    pages = [(t, b, PAGE_ART.get(idx, DEFAULT_ART)) for idx, (t, b) in enumerate(PAGES, start=1)]
+    return Book("Spiders! Eight Legs of Awesome", BOOK_NAME, {n: TRIMS[n] for n in ("8p5x8p5", "8x10")}, pages)
+
+def read_manifest(path):
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, "rb") as f:
+        raw = f.read()
+    if ext == ".json":
+        return json.loads(raw)
+    if ext == ".toml":
+        import tomllib
+        return tomllib.loads(raw.decode("utf-8"))
+    if ext in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError(f"{path}: YAML manifests need PyYAML (pip install pyyaml)")
+        return yaml.safe_load(raw)
+    raise ValueError(f"{path}: unknown manifest type (use {', '.join(MANIFEST_EXTS)})")
+
+def load_manifest(path):
+    return parse_manifest(read_manifest(path), path)
+
+def parse_manifest(data, path="manifest"):
+    # A Book from already-parsed manifest data; path names it in errors and
+    # is where "output" defaults from.
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: manifest must be an object")
+    if not data.get("pages"):
+        raise ValueError(f"{path}: manifest has no pages")
+    trims = data.get("trims", ["8p5x8p5", "8x10"])
+    if isinstance(trims, (list, dict)) and not trims:
+        raise ValueError(f"{path}: trims must name at least one trim")
+    if isinstance(trims, dict):
+        for name, size in trims.items():
+            if not (isinstance(size, (list, tuple)) and len(size) == 2
+                    and all(_number(MIN_TRIM_PX, 10**6, integer=True)(v) for v in size)):
+                raise ValueError(f"{path}: trim {name!r} must be [width, height] in whole pixels, "
+                                 f"{MIN_TRIM_PX} to {10**6} each, not {size!r}")
+        trims = {name: tuple(size) for name, size in trims.items()}
+    elif not isinstance(trims, list) or not all(isinstance(n, str) for n in trims):
+        raise ValueError(f"{path}: trims must be a list of trim names or an object of sizes")
+    else:
+        unknown = [n for n in trims if n not in TRIMS]
+        if unknown:
+            raise ValueError(f"{path}: unknown trim(s) {', '.join(unknown)} (choose from {', '.join(TRIMS)})")
+        trims = {name: TRIMS[name] for name in trims}
+    pages = []
+    if not isinstance(data["pages"], list):
+        raise ValueError(f"{path}: pages must be a list")
+    for n, page in enumerate(data["pages"], start=1):
+        if not isinstance(page, dict) or not isinstance(page.get("title", ""), str) or not isinstance(page.get("body", ""), str):
+            raise ValueError(f"{path}: page {n}: must be an object with text title and body")
+        if not isinstance(page.get("art") or {}, dict):
+            raise ValueError(f"{path}: page {n}: art must be an object")
+        art = dict(page.get("art") or DEFAULT_ART)
+        check_art(art, f"{path}: page {n}")
+        pages.append((page.get("title", ""), page.get("body", ""), art))
+    output = data.get("output") or os.path.splitext(os.path.basename(path))[0]
+    if not isinstance(output, str):
+        raise ValueError(f"{path}: output must be a file name stem, not {output!r}")
+    title = data.get("title", output)
+    if not isinstance(title, str):
+        raise ValueError(f"{path}: title must be text, not {title!r}")
+    return Book(title, output, trims, pages)
+
+def check_art(art, where):
+    # ValueError unless art names a primitive and every parameter is one it
+    # takes, with a sensible value, so a bad page fails at load time rather
+    # than partway through a build.
+    fn = ART_PRIMITIVES.get(art.get("type")) if isinstance(art.get("type"), str) else None
+    if fn is None:
+        raise ValueError(f"{where}: unknown art type {art.get('type')!r} (choose from {', '.join(ART_PRIMITIVES)})")
+    params = {k: v for k, v in art.items() if k != "type"}
+    try:
+        if set(params) & set(BUILDER_ART_PARAMS):
+            raise TypeError(f"{', '.join(sorted(set(params) & set(BUILDER_ART_PARAMS)))} can't be set in a manifest")
+        inspect.signature(fn).bind(None, None, **params)
+    except TypeError as e:
+        raise ValueError(f"{where}: {art['type']} art: {e}")
+    for name, value in params.items():
+        check, wants = ART_PARAMS.get(name, (None, None))
+        if check and not check(value):
+            raise ValueError(f"{where}: {art['type']} art: {name} must be {wants}, not {value!r}")
+
+def find_manifests(directory):
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.lower().endswith(MANIFEST_EXTS))
+
+def dump_manifest(book):
+    return {"title": book.title, "output": book.output,
+            "trims": list(book.trims) if all(TRIMS.get(n) == size for n, size in book.trims.items())
+                     else {n: list(size) for n, size in book.trims.items()},
+            "pages": [{"title": t, "body": b, "art": art} for t, b, art in book.pages]}
+
+# ---------- Personalized Variants ----------
+# One book printed once per reader: {field} placeholders in a page's title or
+# body are filled in from a variants file. Every copy keeps the book's title,
+# so pages without placeholders get the same page key (and art seed) in all
+# of them; build_batch renders those once and reuses the encoded stream in
+# every PDF, leaving only the templated pages to draw per reader.
+TEMPLATE_FIELD = re.compile(r"\{(\w+)\}")
+
+def personal_book():
+    # The built-in book with PERSONAL_PAGES swapped in.
+    book = builtin_book()
+    return book._replace(pages=[(*PERSONAL_PAGES.get(idx, page[:2]), page[2]) for idx, page in enumerate(book.pages, 1)])
+
+def load_variants(path):
+    # [{field: value}, ...] from a .txt (one name per line), .csv (a header
+    # row of field names) or .json (a list of names or of objects) file.
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if ext == ".csv":
+            variants = [{k.strip(): (v or "").strip() for k, v in row.items() if k} for row in csv.DictReader(f)]
+        elif ext == ".json":
+            data = json.load(f)
+            if not isinstance(data, list):
+                raise ValueError(f"{path}: variants must be a list")
+            variants = [v if isinstance(v, dict) else {"name": v} for v in data]
+        else:
+            variants = [{"name": line.strip()} for line in f if line.strip()]
+    if not variants:
+        raise ValueError(f"{path}: no variants")
+    return [{k: str(v) for k, v in fields.items()} for fields in variants]
+
+def is_template(page):
+    return any(TEMPLATE_FIELD.search(text) for text in page[:2])
+
+def personalize(pages, fields, where="variant"):
+    def fill(m):
+        if m[1] not in fields:
+            raise ValueError(f"{where}: no value for {{{m[1]}}}")
+        return fields[m[1]]
+    return [(TEMPLATE_FIELD.sub(fill, t), TEMPLATE_FIELD.sub(fill, b), *rest) for t, b, *rest in pages]
+
+def variant_books(book, variants, out_dir=VARIANTS_DIR, trims=None):
+    # build_batch() input for one copy of book per variant, written as
+    # <output>_<name>_<trim>.pdf (the variant's number if it has no name).
+    if not any(map(is_template, book.pages)):
+        raise ValueError(f"{book.output}: no page has a {{field}} placeholder to personalize")
+    batch, slugs = [], set()
+    for n, fields in enumerate(variants, start=1):
+        slug = re.sub(r"[^\w-]+", "_", fields.get("name", "")).strip("_") or f"{n:03d}"
+        if slug in slugs:
+            slug = f"{slug}_{n}"
+        slugs.add(slug)
+        copy = book._replace(output=f"{book.output}_{slug}", pages=personalize(book.pages, fields, f"variant {n}"))
+        batch.append((book.title, copy.pages, book_targets(copy, out_dir, trims)))
+    return batch
+
 # ---------- Layout + Render ----------
-def make_book(path, size_px):
-    W, H = size_px
-    DPI = 300
+DPI = 300
+
+# Per-build switches that change how a page is drawn; part of every page's cache key.
+#   backend:  "raster" (Pillow image, the default) or "vector" (PDF operators, see PdfCanvas)
+#   encoding: raster page encoding, one of ENCODINGS
+#   quality:  JPEG quality for the jpeg/auto encodings
+#   deterministic: seed every random choice from (book, page, trim) so pages are byte-reproducible
+#   strip_rows: draw raster pages in strips of this many rows (0 = only pages over STRIP_AUTO_PIXELS)
+#   art_backend: "draw" (ImageDraw calls) or "numpy" (array passes for dense patterns, see Array Art)
+#   supersample: draw the art panel at this factor and scale it down (anti-aliasing; 1 = off)
+RenderOptions = namedtuple("RenderOptions", "backend encoding quality deterministic strip_rows art_backend supersample",
+                           defaults=("raster", "jpeg", 75, False, 0, "draw", 1))
+
+# Trim name -> page size in px @ 300 DPI.
+TRIMS = {
+    "8p5x8p5": (2550, 2550),   # 8.5" x 8.5"
+    "8x10":    (2400, 3000),   # 8" x 10"
+    "6x9":     (1800, 2700),   # 6" x 9"
+    "A4":      (2480, 3508),   # 210 x 297 mm
+    "18x24":   (5400, 7200),   # 18" x 24" poster
+    "24x36":   (7200, 10800),  # 24" x 36" wall chart
+}
+# Smallest page side the layout works at: below this the fonts round down
+# to nothing and the art boxes (web_types' insets) turn inside out.
+MIN_TRIM_PX = 2 * DPI
+BOOK_NAME = "Spiders_Eight_Legs_of_Awesome"
+
+# Size-independent page description, computed once and shared by every trim:
+# the text runs (body already broken into lines) and the art call for the page.
+# Panel and art boxes come from page_geometry() for each trim.
+PageSpec = namedtuple("PageSpec", "idx title body lines footer art book")
+
+# Body text is broken once at this reference page size (min(W,H) in px).
+LAYOUT_REF = 10000
 
+def page_fonts(size_px):
+    W, H = size_px
     # Kid-friendly sizes (scaled by page size)
     titleF = load_font(int(0.09*min(W,H)), bold=True)   # ~90–110 pt
     bodyF  = load_font(int(0.055*min(W,H)))            # ~48–56 pt
     smallF = load_font(int(0.035*min(W,H)))            # ~30–36 pt
+    return titleF, bodyF, smallF
 
+def page_geometry(size_px):
+    W, H = size_px
+    titleF, bodyF, smallF = page_fonts(size_px)
     margin = int(0.07 * min(W,H))  # safe margin
-    gutter = int(0.03 * min(W,H))
 
-    pages = []
-    for idx, (p_title, p_body) in enumerate(PAGES, start=1):
-        img = Image.new("RGB", (W, H), (255,255,255))
-        d = ImageDraw.Draw(img)
+    # Art area: LARGE right panel
+    art_left   = int(W*0.48)
+    art_top    = int(margin*1.2)
+    art_right  = W - margin
+    art_bottom = H - margin
+    return {
+        "fonts": (titleF, bodyF, smallF),
+        "title": (margin, margin),
+        "panel": (art_left, art_top, art_right, art_bottom),
+        "art": (art_left+14, art_top+14, art_right-14, art_bottom-14),
+        # Body text: left column, BIG letters
+        "column": (margin, int(margin*2.0), int(W*0.46) - margin),
+        "line_gap": int(bodyF.size*0.15),
+        "footer": (margin, H - margin - smallF.size),
+    }
 
-        # Header
-        d.text((margin, margin), p_title, font=titleF, fill=(20,20,20))
+def describe_page(idx, p_title, p_body, art=None, book=None):
+    geo = page_geometry((LAYOUT_REF, LAYOUT_REF))
+    lines = layout_text(p_body, geo["fonts"][1], geo["column"][2])
+    art = art if art is not None else PAGE_ART.get(idx, DEFAULT_ART)
+    return PageSpec(idx, p_title, p_body, tuple(ln.text for ln in lines), f"Page {idx}", art, book or BOOK_NAME)
 
-        # Art area: LARGE right panel
-        art_left   = int(W*0.48)
-        art_top    = int(margin*1.2)
-        art_right  = W - margin
-        art_bottom = H - margin
-        # soft panel bg
-        d.rectangle((art_left, art_top, art_right, art_bottom), fill=(255,248,230), outline=(255,160,0), width=6)
+def page_rng(spec, size_px, opts):
+    if not opts.deterministic:
+        return random.Random()
+    seed = hashlib.sha256(f"{spec.book}|{spec.idx}|{size_px[0]}x{size_px[1]}".encode()).digest()
+    return random.Random(int.from_bytes(seed[:8], "big"))
 
-        # Draw art by page index
-        draw_art_for_page(d, (art_left+14, art_top+14, art_right-14, art_bottom-14), idx)
+def body_lines(spec, geo):
+    # Reuse the shared line breaks unless this trim's column is shaped
+    # differently or a line no longer fits at this font size.
+    bodyF = geo["fonts"][1]
+    x, y, w = geo["column"]
+    ref = page_geometry((LAYOUT_REF, LAYOUT_REF))
+    same_shape = abs((w / bodyF.size) / (ref["column"][2] / ref["fonts"][1].size) - 1) < 0.02
+    if not same_shape or any(measure(bodyF, ln) > w for ln in spec.lines):
+        return layout_text(spec.body, bodyF, w, x=x, y=y, line_gap=geo["line_gap"])
+    lh = int(bodyF.size*1.15)
+    return [LineBox(ln, x, y + k*(lh + geo["line_gap"]), measure(bodyF, ln), lh) for k, ln in enumerate(spec.lines)]
 
-        # Body text: left column, BIG letters
-        col_x = margin
-        col_y = int(margin*2.0)
-        col_w = int(W*0.46) - margin
-        draw_paragraph(d, p_body, col_x, col_y, col_w, bodyF, line_gap=int(bodyF.size*0.15))
+def new_surface(size_px, opts):
+    if opts.backend == "vector":
+        canvas = PdfCanvas(size_px)
+        return canvas, canvas
+    img = CANVASES.acquire("RGB", size_px, (255,255,255))
+    return img, ImageDraw.Draw(img)
+
+def render_spec(spec, size_px, opts=RenderOptions(), tracer=None):
+    tracer = tracer or NULL_TRACER
+    geo = page_geometry(size_px)
+    with tracer.span("canvas") as sp:
+        img, d = new_surface(size_px, opts)
+        sp["bytes"] = size_px[0] * size_px[1] * 4 if opts.backend == "raster" else 0
+    # seeded the way render_strips seeds each strip, so both draw the same page
+    rng = random.Random(page_rng(spec, size_px, opts).getrandbits(64))
+    draw_page(d, spec, geo, rng, tracer, opts.art_backend == "numpy", opts.supersample)
+    return img
+
+def draw_page(d, spec, geo, rng, tracer=None, arrays=False, supersample=1):
+    tracer = tracer or NULL_TRACER
+    titleF, bodyF, smallF = geo["fonts"]
+    with tracer.span("text"):
+        # Header (under the panel where a long title runs into it)
+        d.text(geo["title"], spec.title, font=titleF, fill=(20,20,20))
+
+    with tracer.span("art"):
+        def panel(d, rng=rng):
+            # soft panel bg
+            d.rectangle(geo["panel"], fill=(255,248,230), outline=(255,160,0), width=6)
+
+            draw_art(d, geo["art"], spec.art, rng, arrays)
+
+        if supersample > 1 and raster_target(d):
+            # every band replays the panel with the same seed
+            seed = rng.getrandbits(64)
+            draw_supersampled(d, geo["panel"], supersample, lambda sd: panel(sd, random.Random(seed)))
+        else:
+            panel(d)
+
+    with tracer.span("text"):
+        draw_lines(d, body_lines(spec, geo), bodyF, fill=(30,30,30))
+
+    with tracer.span("footer"):
+        d.text(geo["footer"], spec.footer, font=smallF, fill=(120,120,120))
+
+def render_page(idx, p_title, p_body, size_px, opts=RenderOptions(), tracer=None, art=None):
+    return render_spec(describe_page(idx, p_title, p_body, art), size_px, opts, tracer)
+
+# ---------- Strip Rendering ----------
+# Poster-sized pages are drawn a band of rows at a time: every strip replays
+# the page's draw calls through an OffsetDraw (Pillow clips what falls
+# outside), is filtered and compressed into the page's one image stream, and
+# is dropped. Memory follows the strip size, not the page size.
+STRIP_ROWS = 512
+STRIP_AUTO_PIXELS = 30_000_000   # ~ 18x24 in @ 300 DPI
+
+def strip_rows(size_px, opts):
+    if opts.backend != "raster":
+        return 0
+    return opts.strip_rows or (STRIP_ROWS if size_px[0] * size_px[1] > STRIP_AUTO_PIXELS else 0)
+
+class OffsetDraw:
+    # ImageDraw stand-in that maps every call to x*scale + dx, y*scale + dy
+    # and skips calls that can't reach the underlying image (height rows
+    # tall). With scale > 1 a page pixel becomes a scale x scale block:
+    # boxes cover whole blocks, points land on block centres and stroke
+    # widths grow with it.
+    def __init__(self, d, dx, dy, height, scale=1):
+        self.d, self.dx, self.dy, self.height, self.scale = d, dx, dy, height, scale
+
+    def _shift(self, xy):
+        if self.scale != 1:
+            c = (self.scale - 1) // 2
+            return self._snap([v*self.scale + c for p in xy for v in p] if isinstance(xy[0], (tuple, list))
+                              else [v*self.scale + c for v in xy])
+        if isinstance(xy[0], (tuple, list)):
+            return [(x + self.dx, y + self.dy) for x, y in xy]
+        return [v + (self.dy if k % 2 else self.dx) for k, v in enumerate(xy)]
+
+    def _box(self, xy):
+        if self.scale == 1:
+            return self._shift(xy)
+        x0, y0, x1, y1 = [v for p in xy for v in p] if isinstance(xy[0], (tuple, list)) else xy
+        s = self.scale
+        return self._snap([x0*s, y0*s, (x1 + 1)*s - 1, (y1 + 1)*s - 1])
+
+    def _snap(self, flat):
+        # Pillow truncates fractional coordinates toward zero, which isn't
+        # shift-invariant once a shape crosses the top of a band; round
+        # before offsetting so every band rasterizes a shape identically.
+        return [math.floor(v + 0.5) + (self.dy if k % 2 else self.dx) for k, v in enumerate(flat)]
+
+    def _visible(self, xy, reach=0):
+        ys = [p[1] for p in xy] if isinstance(xy[0], (tuple, list)) else xy[1::2]
+        return min(ys) - reach < self.height and max(ys) + reach >= 0
+
+    def _draw(self, op, xy, *args, reach=0, **kwargs):
+        xy = self._box(xy) if op in ("rectangle", "ellipse", "arc") else self._shift(xy)
+        if self.scale != 1 and (op in ("line", "arc") or "outline" in kwargs):
+            kwargs["width"] = kwargs.get("width", 1) * self.scale
+        if self._visible(xy, reach + kwargs.get("width", 0)):
+            getattr(self.d, op)(xy, *args, **kwargs)
+
+    def _font(self, font):
+        if self.scale == 1 or not hasattr(font, "font_variant"):
+            return font
+        return font.font_variant(size=round(font.size * self.scale))
+
+    def rectangle(self, xy, *args, **kwargs):
+        self._draw("rectangle", xy, *args, **kwargs)
+
+    def ellipse(self, xy, *args, **kwargs):
+        self._draw("ellipse", xy, *args, **kwargs)
+
+    def arc(self, xy, start, end, *args, **kwargs):
+        self._draw("arc", xy, start, end, *args, **kwargs)
+
+    def line(self, xy, *args, **kwargs):
+        self._draw("line", xy, *args, **kwargs)
+
+    def polygon(self, xy, *args, **kwargs):
+        self._draw("polygon", xy, *args, **kwargs)
 
-        # Footer
-        d.text((margin, H - margin - smallF.size), f"Page {idx}", font=smallF, fill=(120,120,120))
+    def text(self, xy, text, font=None, **kwargs):
+        size = getattr(font, "size", 10) * self.scale
+        xy = [v*self.scale + (self.dy if k % 2 else self.dx) for k, v in enumerate(xy)]
+        if self._visible(xy, 2 * size):
+            self.d.text(xy, text, font=self._font(font), **kwargs)
 
-        pages.append(img)
+    def textlength(self, text, font=None, **kwargs):
+        return self.d.textlength(text, font=font, **kwargs)
 
-    pages[0].save(path, "PDF", resolution=DPI, save_all=True, append_images=pages[1:])
-    print("Wrote", path)
+    def textbbox(self, xy, text, font=None, **kwargs):
+        xy = [v*self.scale + (self.dy if k % 2 else self.dx) for k, v in enumerate(xy)]
+        x0, y0, x1, y1 = self.d.textbbox(xy, text, font=self._font(font), **kwargs)
+        s = self.scale
+        return (x0 - self.dx) / s, (y0 - self.dy) / s, (x1 - self.dx) / s, (y1 - self.dy) / s
+
+# ---------- Supersampling ----------
+# Anti-aliasing for the art panel only: the panel is redrawn at factor x in
+# bands of SUPERSAMPLE_BAND page rows and box-filtered back down with
+# Image.reduce(), so memory is one band at factor**2, not the page.
+SUPERSAMPLE_BAND = 128
+
+def draw_supersampled(d, box, factor, draw, band=SUPERSAMPLE_BAND):
+    # draw(surface) for the part of box on d's image, at factor x resolution.
+    # draw must paint every pixel of box (the panel background does): bands
+    # start blank rather than from an upscaled copy of what was there.
+    im, (dx, dy) = raster_target(d)
+    x0, y0 = max(box[0] + dx, 0), max(box[1] + dy, 0)
+    x1, y1 = min(box[2] + dx + 1, im.width), min(box[3] + dy + 1, im.height)
+    for by in range(y0, y1, band):
+        bh = min(band, y1 - by)
+        hi = CANVASES.acquire(im.mode, ((x1 - x0) * factor, bh * factor))
+        draw(OffsetDraw(ImageDraw.Draw(hi), (dx - x0) * factor, (dy - by) * factor, hi.height, scale=factor))
+        im.paste(hi.reduce(factor), (x0, by))
+        CANVASES.release(hi)
+
+def render_strips(spec, size_px, opts=RenderOptions(), rows=STRIP_ROWS, tracer=None):
+    # Yields (y0, strip image) top to bottom. Each strip redraws the page with
+    # the same seed, so scattered art lands in the same place in every strip.
+    # A strip's buffer is reused once the next one is asked for, so consumers
+    # must copy anything they keep.
+    tracer = tracer or NULL_TRACER
+    geo = page_geometry(size_px)
+    seed = page_rng(spec, size_px, opts).getrandbits(64)
+    W, H = size_px
+    for y0 in range(0, H, rows):
+        with tracer.span("strip", y=y0):
+            strip = CANVASES.acquire("RGB", (W, min(rows, H - y0)), (255,255,255))
+            draw_page(OffsetDraw(ImageDraw.Draw(strip), 0, -y0, strip.height), spec, geo, random.Random(seed),
+                      arrays=opts.art_backend == "numpy", supersample=opts.supersample)
+        yield y0, strip
+        CANVASES.release(strip)
+
+def encode_strips(strips, size_px, level=6):
+    # One Flate image stream from (y0, strip) pairs, rows PNG "Up"-filtered
+    # (the predictor Pillow's PNG encoder also uses most on flat art) so the
+    # PDF side matches encode_flate's /Predictor 15.
+    W, H = size_px
+    stride = W * 3
+    z = zlib.compressobj(level)
+    chunks = []
+    prev = Image.new("RGB", (W, 1), (0,0,0))   # row 0 is filtered against zeros
+    for y0, strip in strips:
+        h = strip.height
+        above = CANVASES.acquire("RGB", strip.size, None)
+        above.paste(prev, (0, 0))
+        above.paste(strip, (0, 1))   # the last row falls off
+        up = ImageChops.subtract_modulo(strip, above).tobytes()
+        CANVASES.release(above)
+        # Filter byte + row, laid out by pasting the rows (as bytes) one
+        # column right of a column of 2s instead of slicing them in Python.
+        rows = CANVASES.acquire("L", (stride + 1, h), None)
+        rows.paste(2, (0, 0, 1, h))
+        rows.paste(Image.frombuffer("L", (stride, h), up, "raw", "L", 0, 1), (1, 0))
+        chunks.append(z.compress(rows.tobytes()))
+        CANVASES.release(rows)
+        prev = strip.crop((0, h - 1, W, h))
+    chunks.append(z.flush())
+    params = f"<< /Predictor 15 /Colors 3 /BitsPerComponent 8 /Columns {W} >>"
+    return PdfImage(W, H, "FlateDecode", "/DeviceRGB", 8, b"".join(chunks), params)
+
+# ---------- Instrumentation ----------
+# Spans are opt-in. NULL_TRACER hands back one shared no-op context manager,
+# so the span() calls can stay on the hot path for free.
+class _Sink(dict):
+    # Span args collected while tracing is off go nowhere.
+    def __setitem__(self, key, value):
+        pass
+
+class _NullSpan:
+    __slots__ = ()
+    _sink = _Sink()
+
+    def __enter__(self):
+        return self._sink
+
+    def __exit__(self, *exc):
+        return False
+
+class NullTracer:
+    enabled = False
+    memory = False
+    events = ()
+    _span = _NullSpan()
+
+    def span(self, name, **args):
+        return self._span
+
+    def extend(self, events):
+        pass
+
+NULL_TRACER = NullTracer()
+
+class Tracer:
+    # Records one event per span: wall-clock start/duration (us), pid/tid and,
+    # with memory=True, the change in traced Python heap (tracemalloc). Pillow
+    # allocates pixel buffers outside the Python heap, so spans that allocate
+    # them also report "bytes". Events go to self.events and to `callback`.
+    enabled = True
+
+    def __init__(self, callback=None, memory=True):
+        self.events = []
+        self.callback = callback
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def span(self, name, **args):
+        mem0 = tracemalloc.get_traced_memory()[0] if self.memory else 0
+        t0 = time.time_ns()
+        try:
+            yield args
+        finally:
+            t1 = time.time_ns()
+            event = {"name": name, "ts": t0 // 1000, "dur": (t1 - t0) // 1000,
+                     "pid": os.getpid(), "tid": threading.get_ident(), "args": args}
+            if self.memory:
+                event["alloc"] = tracemalloc.get_traced_memory()[0] - mem0
+            self.extend([event])
+
+    def extend(self, events):
+        # Also how events recorded in pool workers reach the parent's tracer.
+        for event in events:
+            self.events.append(event)
+            if self.callback:
+                self.callback(event)
+
+    def summary(self):
+        totals = {}
+        for e in self.events:
+            t = totals.setdefault(e["name"], {"count": 0, "dur_us": 0, "alloc": 0})
+            t["count"] += 1
+            t["dur_us"] += e["dur"]
+            t["alloc"] += e.get("alloc", 0)
+        return totals
+
+    def write_chrome_trace(self, path):
+        # Loadable in chrome://tracing and Perfetto.
+        events = [{"name": e["name"], "ph": "X", "ts": e["ts"], "dur": e["dur"], "pid": e["pid"], "tid": e["tid"],
+                   "args": dict(e["args"], **({"alloc_bytes": e["alloc"]} if "alloc" in e else {}))}
+                  for e in self.events]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+# ---------- PDF Output (streaming) ----------
+# One encoded page image, ready to drop into a PDF as an image XObject.
+# colorspace and params are PDF syntax (e.g. "/DeviceRGB", "<< /Predictor 15 ... >>").
+PdfImage = namedtuple("PdfImage", "width height filter colorspace bpc data params", defaults=(None,))
+
+# Page image encodings (--encoding):
+#   jpeg    - baseline JPEG, what Pillow's PDF driver uses; best for photographic pages
+#   flate   - lossless zlib with PNG row predictors
+#   palette - indexed color (exact when the page has <= 256 colors, else quantized) + flate
+#   auto    - whichever of the above comes out smallest for this page
+ENCODINGS = ("jpeg", "flate", "palette", "auto")
+
+def _png_parts(data):
+    # Bit depth, PLTE bytes and the joined IDAT stream of a PNG. IDAT is zlib
+    # over predictor-filtered rows, exactly what PDF's /Predictor 15 expects.
+    # data may be a memoryview, so chunks are joined without copying each.
+    pos, plte, idat = 8, None, []
+    while pos < len(data):
+        n, kind = struct.unpack(">I4s", data[pos:pos+8])
+        chunk = data[pos+8:pos+8+n]
+        if kind == b"IHDR":
+            bits = chunk[8]
+        elif kind == b"PLTE":
+            plte = bytes(chunk)
+        elif kind == b"IDAT":
+            idat.append(chunk)
+        pos += 12 + n
+    return bits, plte, b"".join(idat)
+
+def is_gray(img):
+    # Splitting the page copies it three times over, so a nearest-neighbour
+    # sample (real pixels, nothing blended) rules out most color pages first.
+    for probe in (img.resize((64, 64), Image.NEAREST), img):
+        r, g, b = probe.split()
+        if ImageChops.difference(r, g).getbbox() is not None or ImageChops.difference(g, b).getbbox() is not None:
+            return False
+    return True
+
+def to_palette(img):
+    # Exact for pages of <= 256 colors: median cut gives each color its own
+    # entry (quantize(palette=...) snaps to a coarse lookup and shifts
+    # colors). Should that ever not round-trip, the page stays RGB.
+    colors = img.getcolors(256)
+    if colors:
+        pimg = img.quantize(len(colors), method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+        return pimg if ImageChops.difference(pimg.convert("RGB"), img).getbbox() is None else img
+    return img.quantize(256, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+
+def encode_jpeg(img, quality=75):
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=quality)
+    return PdfImage(img.width, img.height, "DCTDecode", "/DeviceGray" if img.mode == "L" else "/DeviceRGB", 8, buf.getvalue())
+
+def encode_flate(img):
+    buf = io.BytesIO()
+    img.save(buf, "PNG", compress_level=6)
+    bits, plte, idat = _png_parts(buf.getbuffer())
+    if img.mode == "P":
+        colorspace = f"[/Indexed /DeviceRGB {len(plte)//3 - 1} <{plte.hex()}>]"
+    else:
+        colorspace = "/DeviceGray" if img.mode == "L" else "/DeviceRGB"
+    colors = 3 if img.mode == "RGB" else 1
+    params = f"<< /Predictor 15 /Colors {colors} /BitsPerComponent {bits} /Columns {img.width} >>"
+    return PdfImage(img.width, img.height, "FlateDecode", colorspace, bits, idat, params)
+
+def encode_page(img, encoding="jpeg", quality=75):
+    if encoding != "jpeg" and is_gray(img):
+        img = img.convert("L")
+    if encoding == "jpeg":
+        return encode_jpeg(img, quality)
+    if encoding == "flate":
+        return encode_flate(img)
+    if encoding == "palette":
+        return encode_flate(img if img.mode == "L" else to_palette(img))
+    if encoding == "auto":
+        candidates = [encode_jpeg(img, quality), encode_flate(img)]
+        if img.mode == "RGB":
+            candidates.append(encode_flate(to_palette(img)))
+        return min(candidates, key=lambda p: len(p.data))
+    raise ValueError(f"unknown page encoding {encoding!r} (choose from {', '.join(ENCODINGS)})")
+
+def pdf_date(t=None):
+    return time.strftime("D:%Y%m%d%H%M%SZ", time.gmtime(t))
+
+def pdf_string(text):
+    return "(" + text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+def files_equal(a, b):
+    if not (os.path.exists(a) and os.path.exists(b)) or os.path.getsize(a) != os.path.getsize(b):
+        return False
+    with open(a, "rb") as fa, open(b, "rb") as fb:
+        while True:
+            ca, cb = fa.read(1 << 20), fb.read(1 << 20)
+            if ca != cb:
+                return False
+            if not ca:
+                return True
+
+class PdfWriter:
+    # Writes each page to disk as soon as it is added, so memory stays at one
+    # page no matter how long the book is. Objects 1-3 (catalog, page tree,
+    # info) are reserved up front and written last, next to the xref table.
+    # Output goes to path + ".tmp" and only replaces path if the bytes differ
+    # (self.unchanged tells which).
+    #
+    # deterministic=True drops the wall-clock dates (or takes them from
+    # SOURCE_DATE_EPOCH), so identical pages give a byte-identical file. The
+    # trailer /ID is always a digest of the content. linearize=True rewrites
+    # the finished file for fast web view (see linearize_pdf).
+    def __init__(self, path, resolution=DPI, title=None, deterministic=False, linearize=False):
+        self.path = path
+        self.tmp = path + ".tmp"
+        self.resolution = resolution
+        self.linearize = linearize
+        self.fp = open(self.tmp, "wb")
+        self.digest = hashlib.md5()
+        self.unchanged = False
+        self.state = None
+        self.offsets = {}
+        self.kids = []
+        self.font_ids = {}     # font source -> object id, written on close
+        self.font_chars = {}   # font source -> characters used (for subsetting)
+        self.next_id = 4
+        self.info = {"Title": title if title is not None else os.path.splitext(os.path.basename(path))[0]}
+        epoch = os.environ.get("SOURCE_DATE_EPOCH")
+        if not deterministic or epoch:
+            self.info["CreationDate"] = self.info["ModDate"] = pdf_date(int(epoch) if epoch else None)
+        self.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif not self.fp.closed:
+            self.fp.close()
+            os.remove(self.tmp)
+
+    def write(self, data):
+        self.fp.write(data)
+        self.digest.update(data)
+
+    def alloc(self):
+        self.next_id += 1
+        return self.next_id - 1
+
+    def write_obj(self, oid, body, stream=None):
+        self.offsets[oid] = self.fp.tell()
+        if stream is not None:
+            body = body[:-2] + f" /Length {len(stream)} >>"
+        self.write(f"{oid} 0 obj\n{body}\n".encode("latin-1"))
+        if stream is not None:
+            self.write(b"stream\n")
+            self.write(stream)
+            self.write(b"\nendstream\n")
+        self.write(b"endobj\n")
+
+    def add_page(self, pimg, page_id=None):
+        # page_id: redefine that page object instead of appending a page (PdfPatcher)
+        if isinstance(pimg, VectorPage):
+            return self.add_vector_page(pimg)
+        img_id, new_id, contents_id = self.alloc(), page_id or self.alloc(), self.alloc()
+        pw = pimg.width * 72.0 / self.resolution
+        ph = pimg.height * 72.0 / self.resolution
+        procset = {"/DeviceGray": "/ImageB", "/DeviceRGB": "/ImageC"}.get(pimg.colorspace, "/ImageI")
+        params = f" /DecodeParms {pimg.params}" if pimg.params else ""
+        self.write_obj(img_id, f"<< /Type /XObject /Subtype /Image /Width {pimg.width} /Height {pimg.height} "
+                               f"/ColorSpace {pimg.colorspace} /BitsPerComponent {pimg.bpc} /Filter /{pimg.filter}{params} >>",
+                       pimg.data)
+        self.write_obj(new_id, f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {pw:f} {ph:f}] "
+                               f"/Resources << /ProcSet [/PDF {procset}] /XObject << /image {img_id} 0 R >> >> "
+                               f"/Contents {contents_id} 0 R >>")
+        self.write_obj(contents_id, "<< >>", b"q %f 0 0 %f 0 0 cm /image Do Q\n" % (pw, ph))
+        if page_id is None:
+            self.kids.append(new_id)
+
+    def add_vector_page(self, vpage):
+        page_id, contents_id = self.alloc(), self.alloc()
+        pw = vpage.width * 72.0 / self.resolution
+        ph = vpage.height * 72.0 / self.resolution
+        fonts = []
+        for res, source, chars in vpage.fonts:
+            if source not in self.font_ids:
+                self.font_ids[source] = self.alloc()
+                self.font_chars[source] = set()
+            self.font_chars[source].update(chars)
+            fonts.append(f"/{res} {self.font_ids[source]} 0 R")
+        self.write_obj(page_id, f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {pw:f} {ph:f}] "
+                                f"/Resources << /ProcSet [/PDF /Text] /Font << {' '.join(fonts)} >> >> "
+                                f"/Contents {contents_id} 0 R >>")
+        self.write_obj(contents_id, "<< /Filter /FlateDecode >>", vpage.data)
+        self.kids.append(page_id)
+
+    def write_fonts(self):
+        for source, oid in self.font_ids.items():
+            if source.startswith("std:"):
+                self.write_obj(oid, f"<< /Type /Font /Subtype /Type1 /BaseFont /{source[4:]} /Encoding /WinAnsiEncoding >>")
+                continue
+            f1000 = get_font(source, 1000)
+            ascent, descent = f1000.getmetrics()
+            widths = " ".join(str(round(f1000.getlength(bytes([c]).decode("cp1252", "replace")))) for c in range(32, 256))
+            program, subset = font_program(source, self.font_chars[source])
+            name = "".join(f1000.getname()).replace(" ", "")
+            if subset:
+                name = "".join(chr(65 + int(c, 16) % 26) for c in hashlib.sha1(program).hexdigest()[:6]) + "+" + name
+            desc_id, file_id = self.alloc(), self.alloc()
+            self.write_obj(oid, f"<< /Type /Font /Subtype /TrueType /BaseFont /{name} /FirstChar 32 /LastChar 255 "
+                                f"/Widths [{widths}] /Encoding /WinAnsiEncoding /FontDescriptor {desc_id} 0 R >>")
+            self.write_obj(desc_id, f"<< /Type /FontDescriptor /FontName /{name} /Flags 32 "
+                                    f"/FontBBox [0 {-descent} 1000 {ascent}] /ItalicAngle 0 /Ascent {ascent} "
+                                    f"/Descent {-descent} /CapHeight {ascent} /StemV 80 /FontFile2 {file_id} 0 R >>")
+            self.write_obj(file_id, f"<< /Length1 {len(program)} /Filter /FlateDecode >>", zlib.compress(program))
+
+    def close(self):
+        if self.fp.closed:
+            return
+        self.write_fonts()
+        kids = " ".join(f"{k} 0 R" for k in self.kids)
+        self.write_obj(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self.kids)} >>")
+        self.write_obj(1, "<< /Type /Catalog /Pages 2 0 R >>")
+        self.write_obj(3, "<< " + " ".join(f"/{k} {pdf_string(v)}" for k, v in self.info.items()) + " >>")
+        xref = self.fp.tell()
+        self.write(f"xref\n0 {self.next_id}\n0000000000 65535 f \n".encode())
+        for oid in range(1, self.next_id):
+            self.write(f"{self.offsets[oid]:010d} 00000 n \n".encode())
+        doc_id = self.digest.hexdigest()
+        self.write(f"trailer\n<< /Size {self.next_id} /Root 1 0 R /Info 3 0 R /ID [<{doc_id}> <{doc_id}>] >>\n"
+                   f"startxref\n{xref}\n%%EOF\n".encode())
+        length = self.fp.tell()
+        self.fp.close()
+        if self.linearize:
+            linearize_pdf(self.tmp)   # renumbers objects, so no state to patch against
+        else:
+            self.state = PdfState(tuple(self.kids), self.next_id, xref, (doc_id, doc_id), length, length)
+        self.unchanged = files_equal(self.tmp, self.path)
+        if self.unchanged:
+            os.remove(self.tmp)
+        else:
+            os.replace(self.tmp, self.path)
+
+# Where a finished PDF's objects are, so PdfPatcher can update it later:
+# page object ids, next free id, last xref offset, trailer /ID pair, file
+# length now and right after the last full write.
+PdfState = namedtuple("PdfState", "kids size xref ids length base")
+
+class PdfPatcher(PdfWriter):
+    # Incremental update of a PDF that PdfWriter wrote: the pages at
+    # positions (in the order add_page() is called) get new image, page and
+    # content objects appended, the page objects keeping their ids, followed
+    # by an xref section that chains to the previous one (/Prev). Readers
+    # take the newest version of each object, so replacing a page costs that
+    # page's bytes (plus a file copy), not re-encoding the book. Raster pages
+    # only. The update is made on a copy that replaces path on close, so
+    # nothing ever reads a half-appended file.
+    def __init__(self, path, state, positions, resolution=DPI):
+        self.path = path
+        self.tmp = path + ".tmp"
+        self.resolution = resolution
+        self.linearize = False
+        self.prev = state
+        self.positions = iter(positions)
+        shutil.copyfile(path, self.tmp)
+        self.fp = open(self.tmp, "r+b")
+        self.fp.seek(state.length)
+        self.fp.truncate()
+        self.digest = hashlib.md5(state.ids[1].encode())
+        self.unchanged = False
+        self.state = None
+        self.offsets = {}
+        self.kids = list(state.kids)
+        self.next_id = state.size
+
+    def add_page(self, pimg):
+        super().add_page(pimg, page_id=self.kids[next(self.positions)])
+
+    def close(self):
+        if self.fp.closed:
+            return
+        xref = self.fp.tell()
+        self.write(b"xref\n0 1\n0000000000 65535 f \n")
+        for oid in sorted(self.offsets):
+            self.write(f"{oid} 1\n{self.offsets[oid]:010d} 00000 n \n".encode())
+        ids = (self.prev.ids[0], self.digest.hexdigest())
+        self.write(f"trailer\n<< /Size {self.next_id} /Root 1 0 R /Info 3 0 R /Prev {self.prev.xref} "
+                   f"/ID [<{ids[0]}> <{ids[1]}>] >>\nstartxref\n{xref}\n%%EOF\n".encode())
+        self.state = PdfState(tuple(self.kids), self.next_id, xref, ids, self.fp.tell(), self.prev.base)
+        self.fp.close()
+        os.replace(self.tmp, self.path)
+
+def linearize_pdf(path):
+    # Rewrites path in place as a linearized ("fast web view") PDF, so a
+    # viewer can show page 1 before the rest has downloaded. Uses the qpdf
+    # command or pikepdf; returns False (file untouched) if neither exists.
+    out = path + ".lin"
+    qpdf = shutil.which("qpdf")
+    if qpdf:
+        # exit status 3 means "succeeded with warnings"
+        if subprocess.run([qpdf, "--linearize", "--deterministic-id", path, out]).returncode not in (0, 3):
+            raise RuntimeError(f"qpdf could not linearize {path}")
+    elif pikepdf:
+        with pikepdf.open(path) as pdf:
+            pdf.save(out, linearize=True, deterministic_id=True)
+    else:
+        return False
+    os.replace(out, path)
+    return True
+
+# ---------- Web Derivatives ----------
+# Smaller files for the PWA, cut from the full-resolution page raster while it
+# is still in memory: a thumbnail per page and a low-DPI "screen edition".
+#   thumb_width:  thumbnail width in px (height follows the trim)
+#   thumb_format: "webp" or "png" (png if this Pillow has no WebP support)
+#   screen_dpi:   resolution of the screen edition; 0 = no screen edition
+#   screen_quality: JPEG quality for screen edition pages
+#   linearize:    linearize every PDF written (needs qpdf or pikepdf)
+Derivatives = namedtuple("Derivatives", "thumb_width thumb_format screen_dpi screen_quality linearize",
+                         defaults=(320, "webp", 96, 60, True))
+Thumbnail = namedtuple("Thumbnail", "width height format data")
+Derived = namedtuple("Derived", "screen thumb")   # screen: PdfImage or None (vector backend)
+
+def thumb_format(derivs):
+    if derivs.thumb_format == "webp" and not features.check("webp"):
+        return "png"
+    return derivs.thumb_format
+
+def scaled(img, width):
+    return img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS, reducing_gap=3.0)
+
+def screen_size(size_px, derivs):
+    dpi = derivs.screen_dpi or 96
+    return round(size_px[0] * dpi / DPI), round(size_px[1] * dpi / DPI)
+
+def derive_page(page, spec, size_px, opts, derivs, tracer=None, small=None):
+    # small: the page already scaled to screen_size() (strip rendering builds
+    # it as it goes), in place of the full page.
+    tracer = tracer or NULL_TRACER
+    screen = None
+    with tracer.span("derive", idx=spec.idx):
+        dpi = derivs.screen_dpi or 96
+        if small is not None:
+            if derivs.screen_dpi:
+                screen = encode_page(small, opts.encoding, derivs.screen_quality)
+        elif isinstance(page, PdfCanvas):
+            # The vector PDF is already small enough to serve as is; the
+            # thumbnail still needs pixels, drawn straight at screen size.
+            small = render_spec(spec, screen_size(size_px, derivs), opts._replace(backend="raster"))
+        else:
+            small = scaled(page, round(page.width * dpi / DPI))
+            if derivs.screen_dpi:
+                screen = encode_page(small, opts.encoding, derivs.screen_quality)
+        thumb = scaled(small, derivs.thumb_width)
+        fmt = thumb_format(derivs)
+        buf = io.BytesIO()
+        thumb.save(buf, fmt, **({"quality": 80, "method": 4} if fmt == "webp" else {"optimize": True}))
+    return Derived(screen, Thumbnail(thumb.width, thumb.height, fmt, buf.getvalue()))
+
+def derivative_paths(path, derivs):
+    # books/X_8x10.pdf -> books/X_8x10_screen.pdf, books/thumbs/X_8x10/page-NNN.<fmt>
+    stem, ext = os.path.splitext(path)
+    thumbs = os.path.join(os.path.dirname(path), "thumbs", os.path.basename(stem))
+    return (stem + "_screen" + ext if derivs.screen_dpi else None), thumbs
+
+def write_if_changed(path, data):
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    except OSError:
+        pass
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return True
+
+# ---------- Vector Backend ----------
+# A vector page: compressed content stream plus the fonts it uses as
+# (resource name, font source, characters used) triples.
+VectorPage = namedtuple("VectorPage", "width height fonts data")
+
+KAPPA = 0.5522847498   # Bezier control-point ratio for quarter circles
+
+def _num(v):
+    return ("%.2f" % v).rstrip("0").rstrip(".")
+
+def font_source(font):
+    # Embeddable TrueType file, or one of the standard 14 PDF fonts.
+    path = font_file(font)
+    if path.lower().endswith((".ttf", ".otf")):
+        return path
+    try:
+        bold = "Bold" in font.getname()[1]
+    except (AttributeError, TypeError):
+        bold = False
+    return "std:Helvetica-Bold" if bold else "std:Helvetica"
+
+def font_program(path, chars):
+    # Font file bytes to embed, subset to the used characters when fontTools is around.
+    if ft_subset is None:
+        with open(path, "rb") as f:
+            return f.read(), False
+    options = ft_subset.Options()
+    options.notdef_outline = True
+    options.name_IDs = ["*"]
+    options.drop_tables += ["FFTM"]   # FontForge timestamps
+    font = ft_subset.load_font(path, options)
+    subsetter = ft_subset.Subsetter(options)
+    subsetter.populate(text="".join(sorted(chars)) + " ")
+    subsetter.subset(font)
+    buf = io.BytesIO()
+    ft_subset.save_font(font, buf, options)
+    return buf.getvalue(), True
+
+class PdfCanvas:
+    # ImageDraw-compatible surface that records PDF path and text operators
+    # instead of pixels. Coordinates stay in page pixels (y down); the content
+    # stream's initial transform maps them to points.
+    def __init__(self, size, resolution=DPI):
+        self.size = size
+        self.fonts = {}   # font source -> (resource name, used chars)
+        k = 72.0 / resolution
+        self.ops = [f"q {_num(k)} 0 0 {_num(-k)} 0 {_num(size[1]*k)} cm"]
+
+    def _color(self, c, op):
+        if isinstance(c, int):
+            c = (c, c, c)
+        return " ".join(_num(v/255) for v in c[:3]) + " " + op
+
+    def _box(self, xy):
+        if isinstance(xy[0], (tuple, list)):
+            (x0, y0), (x1, y1) = xy
+        else:
+            x0, y0, x1, y1 = xy
+        return x0, y0, x1 + 1, y1 + 1
+
+    def _points(self, xy):
+        if isinstance(xy[0], (tuple, list)):
+            return [tuple(p) for p in xy]
+        return list(zip(xy[0::2], xy[1::2]))
+
+    def _arc_path(self, box, start, end, move=True):
+        x0, y0, x1, y1 = box
+        cx, cy, rx, ry = (x0+x1)/2, (y0+y1)/2, (x1-x0)/2, (y1-y0)/2
+        while end < start:
+            end += 360
+        n = max(1, math.ceil((end - start) / 90))
+        step = math.radians(end - start) / n
+        a = math.radians(start)
+        k = 4/3 * math.tan(step/4)
+        path = [f"{_num(cx + rx*math.cos(a))} {_num(cy + ry*math.sin(a))} m"] if move else []
+        for _ in range(n):
+            b = a + step
+            c1 = (cx + rx*(math.cos(a) - k*math.sin(a)), cy + ry*(math.sin(a) + k*math.cos(a)))
+            c2 = (cx + rx*(math.cos(b) + k*math.sin(b)), cy + ry*(math.sin(b) - k*math.cos(b)))
+            p = (cx + rx*math.cos(b), cy + ry*math.sin(b))
+            path.append(" ".join(_num(v) for v in c1 + c2 + p) + " c")
+            a = b
+        return " ".join(path)
+
+    def _inset(self, box, w):
+        x0, y0, x1, y1 = box
+        return x0 + w/2, y0 + w/2, x1 - w/2, y1 - w/2
+
+    def rectangle(self, xy, fill=None, outline=None, width=1):
+        x0, y0, x1, y1 = self._box(xy)
+        if fill is not None:
+            self.ops.append(f"{self._color(fill, 'rg')} {_num(x0)} {_num(y0)} {_num(x1-x0)} {_num(y1-y0)} re f")
+        if outline is not None and width:
+            x0, y0, x1, y1 = self._inset((x0, y0, x1, y1), width)
+            self.ops.append(f"{self._color(outline, 'RG')} {_num(width)} w {_num(x0)} {_num(y0)} {_num(x1-x0)} {_num(y1-y0)} re S")
+
+    def ellipse(self, xy, fill=None, outline=None, width=1):
+        box = self._box(xy)
+        if fill is not None:
+            self.ops.append(f"{self._color(fill, 'rg')} {self._arc_path(box, 0, 360)} h f")
+        if outline is not None and width:
+            self.ops.append(f"{self._color(outline, 'RG')} {_num(width)} w {self._arc_path(self._inset(box, width), 0, 360)} h S")
+
+    def arc(self, xy, start, end, fill=None, width=1):
+        box = self._inset(self._box(xy), width)
+        self.ops.append(f"{self._color(fill if fill is not None else 0, 'RG')} {_num(width)} w 0 J {self._arc_path(box, start, end)} S")
+
+    def line(self, xy, fill=None, width=0):
+        pts = self._points(xy)
+        path = " ".join(f"{_num(x)} {_num(y)} {'m' if i == 0 else 'l'}" for i, (x, y) in enumerate(pts))
+        self.ops.append(f"{self._color(fill if fill is not None else 0, 'RG')} {_num(max(width, 1))} w 0 J {path} S")
+
+    def polygon(self, xy, fill=None, outline=None, width=1):
+        pts = self._points(xy)
+        path = " ".join(f"{_num(x)} {_num(y)} {'m' if i == 0 else 'l'}" for i, (x, y) in enumerate(pts)) + " h"
+        if fill is not None:
+            self.ops.append(f"{self._color(fill, 'rg')} {path} f")
+        if outline is not None and width:
+            self.ops.append(f"{self._color(outline, 'RG')} {_num(width)} w 0 j {path} S")
+
+    def text(self, xy, text, fill=None, font=None, **kwargs):
+        source = font_source(font)
+        if source not in self.fonts:
+            self.fonts[source] = (f"F{len(self.fonts) + 1}", set())
+        res, chars = self.fonts[source]
+        text = text.replace("\n", " ")
+        chars.update(text)
+        raw = text.encode("cp1252", "replace").decode("latin-1")
+        raw = raw.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+        # Pillow anchors text at the ascender; PDF at the baseline. Text
+        # space gets its own y flip so glyphs come out upright.
+        x, y = xy
+        baseline = y + font.getmetrics()[0]
+        self.ops.append(f"{self._color(fill if fill is not None else 0, 'rg')} BT /{res} {font.size} Tf "
+                        f"1 0 0 -1 {_num(x)} {_num(baseline)} Tm ({raw}) Tj ET")
+
+    def textlength(self, text, font=None, **kwargs):
+        return font.getlength(text)
+
+    def textbbox(self, xy, text, font=None, **kwargs):
+        x0, y0, x1, y1 = font.getbbox(text)
+        return xy[0] + x0, xy[1] + y0, xy[0] + x1, xy[1] + y1
+
+    def finish(self):
+        content = "\n".join(self.ops + ["Q"]).encode("latin-1")
+        fonts = tuple((res, source, "".join(sorted(chars))) for source, (res, chars) in self.fonts.items())
+        return VectorPage(self.size[0], self.size[1], fonts, zlib.compress(content))
+
+# ---------- Page Cache ----------
+# Bump when a change affects rendered pages in a way the code fingerprint can't see.
+BUILDER_VERSION = "3.1"
+
+def _code_names(code):
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if hasattr(c, "co_names"):
+            names |= _code_names(c)
+    return names
+
+def _code_sig(code):
+    # What a function does, ignoring where in the file it sits. Set
+    # constants (`x in {...}`) are sorted: their order changes per process.
+    return (code.co_code, code.co_names, code.co_varnames,
+            tuple(_code_sig(c) if inspect.iscode(c) else tuple(sorted(map(repr, c))) if isinstance(c, frozenset) else c
+                  for c in code.co_consts))
+
+def _function_sig(fn):
+    return _code_sig(fn.__code__), fn.__defaults__, fn.__kwdefaults__
+
+@functools.lru_cache(maxsize=None)
+def _object_digest(obj):
+    # (hash, global names used) of one module-level function or class, from
+    # its code objects: no source to read or parse, and shared by every
+    # fingerprint that reaches it. A class counts by its bases, plain
+    # attributes (namedtuple fields) and methods.
+    if inspect.isclass(obj):
+        members = sorted(vars(obj).items())
+        methods = [v for _, v in members if inspect.isfunction(v) and v.__module__ == obj.__module__]
+        attrs = [(k, v) for k, v in members if not k.startswith("__")
+                 and isinstance(v, (bool, int, float, str, bytes, tuple, dict, type(None)))]
+        bases = [b.__name__ for b in obj.__bases__]
+        sig = (obj.__qualname__, bases, attrs, [(m.__name__, _function_sig(m)) for m in methods])
+        names = set(bases).union(*(_code_names(m.__code__) for m in methods))
+    else:
+        sig = (obj.__qualname__, _function_sig(obj))
+        names = _code_names(obj.__code__)
+    return hashlib.sha256(repr(sig).encode()).hexdigest(), frozenset(names)
+
+def _plain(v):
+    # Numbers, strings and tuples of them: constants hashed by value.
+    return isinstance(v, (int, float, str, bytes)) or isinstance(v, tuple) and all(map(_plain, v))
+
+@functools.lru_cache(maxsize=None)
+def code_fingerprint(fn):
+    # fn plus every module-level function or class it (transitively) uses,
+    # and the plain constants (DPI, WEB_FIELD_SUB, ...) they read. Tables
+    # like PAGES and ART_PRIMITIVES are content and keyed per page instead.
+    h = hashlib.sha256()
+    seen, stack = set(), [fn]
+    while stack:
+        f = stack.pop()
+        if f.__name__ in seen:
+            continue
+        seen.add(f.__name__)
+        digest, names = _object_digest(f)
+        h.update(digest.encode())
+        for name in sorted(names, reverse=True):
+            g = globals().get(name)
+            if _plain(g) and not name.startswith("__"):
+                if name not in seen:
+                    seen.add(name)
+                    h.update(repr((name, g)).encode())
+                continue
+            g = getattr(g, "__wrapped__", g)   # lru_cached helpers count by their code too
+            if (inspect.isfunction(g) or inspect.isclass(g)) and g.__module__ == f.__module__:
+                stack.append(g)
+    return h.hexdigest()
+
+def font_file(font):
+    path = getattr(font, "path", None)
+    return path if isinstance(path, str) else "default"
+
+def page_key(job):
+    spec, size_px, opts = job
+    h = hashlib.sha256()
+    # Art is looked up through ART_PRIMITIVES, which the fingerprint walk
+    # doesn't follow, so each page hashes its own primitive: editing one art
+    # function only invalidates the pages that draw it.
+    art_fn = ART_PRIMITIVES.get(spec.art.get("type"))
+    for part in (BUILDER_VERSION, Image.__version__, code_fingerprint(_render_page_job), art_fn and code_fingerprint(art_fn),
+                 spec._replace(art=json.dumps(spec.art, sort_keys=True)), size_px, tuple(opts), [font_file(f) for f in page_fonts(size_px)]):
+        h.update(repr(part).encode() + b"\0")
+    return h.hexdigest()
+
+def job_key(job):
+    # A page's name within one build: the job alone, without the code and
+    # font fingerprints that page_key adds for use across builds.
+    spec, size_px, opts = job
+    return hashlib.sha256(repr((spec._replace(art=json.dumps(spec.art, sort_keys=True)), size_px, tuple(opts))).encode()).hexdigest()
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key + ".page")
+
+def derived_key(key, derivs):
+    return hashlib.sha256(f"{key}|{tuple(derivs)}|{features.check('webp')}".encode()).hexdigest()
+
+def cache_load(cache_dir, key):
+    try:
+        with open(cache_path(cache_dir, key), "rb") as f:
+            head = json.loads(f.readline())
+            kind = head.pop("kind", "PdfImage")
+            if kind == "VectorPage":
+                head["fonts"] = tuple(map(tuple, head["fonts"]))
+            return {"PdfImage": PdfImage, "VectorPage": VectorPage, "Thumbnail": Thumbnail}[kind](data=f.read(), **head)
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+
+def cache_load_derived(cache_dir, key):
+    # Thumbnail under the derived key itself, screen page (if any) next to it.
+    thumb = cache_load(cache_dir, key)
+    screen = cache_load(cache_dir, key + "s")
+    return Derived(screen, thumb) if thumb else None
+
+def cache_store_derived(cache_dir, key, derived):
+    cache_store(cache_dir, key, derived.thumb)
+    if derived.screen:
+        cache_store(cache_dir, key + "s", derived.screen)
+
+def cache_store(cache_dir, key, pimg):
+    path = cache_path(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    head = {k: v for k, v in pimg._asdict().items() if k != "data"}
+    head["kind"] = type(pimg).__name__
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(json.dumps(head).encode() + b"\n")
+        f.write(pimg.data)
+    os.replace(tmp, path)
+
+# ---------- Precache Manifest ----------
+# books/precache-manifest.json tells service-worker.js what the current book
+# artifacts are: URL (relative to the manifest), sha256 and size. The worker
+# caches each file under its hash, so a deploy only refetches what changed.
+PRECACHE_MANIFEST = "precache-manifest.json"
+ARTIFACT_EXTS = (".pdf", ".webp", ".png")
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def precache_manifest(out_dir):
+    assets = []
+    for dirpath, dirnames, filenames in os.walk(out_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.endswith(ARTIFACT_EXTS):
+                path = os.path.join(dirpath, name)
+                assets.append({"url": os.path.relpath(path, out_dir).replace(os.sep, "/"),
+                               "sha256": file_sha256(path), "bytes": os.path.getsize(path)})
+    # version changes whenever any artifact does; no timestamps, so an
+    # unchanged build leaves the manifest byte-identical.
+    version = hashlib.sha256(json.dumps(assets, sort_keys=True).encode()).hexdigest()[:16]
+    return {"version": version, "assets": assets}
+
+def write_precache_manifest(out_dir):
+    manifest = precache_manifest(out_dir)
+    path = os.path.join(out_dir, PRECACHE_MANIFEST)
+    changed = write_if_changed(path, (json.dumps(manifest, indent=2) + "\n").encode())
+    print(f"{'Wrote' if changed else 'Unchanged'} {path} ({len(manifest['assets'])} artifacts, version {manifest['version']})")
+    return manifest
+
+# ---------- Background Writes ----------
+# build_batch hands every file write (cache entries, PDF pages, thumbnails,
+# closing and linearizing a book) to one thread, which runs them in the order
+# given while the next pages render. At most `depth` tasks wait in the
+# queue, so a slow disk stalls the renderer instead of letting finished pages
+# pile up in memory.
+WRITE_QUEUE = 8
+
+class WriteQueue:
+    def __init__(self, depth=WRITE_QUEUE):
+        self.tasks = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="writer", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.error is None:
+            self.error = exc   # the caller failed: skip whatever is still queued
+        self.close(raise_error=exc_type is None)
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            if self.error is None:   # after a failure the rest is skipped, not run
+                try:
+                    task()
+                except BaseException as e:
+                    self.error = e
+
+    def submit(self, fn, *args, **kwargs):
+        # Blocks while the queue is full; raises the writer's error, if any.
+        if self.error is not None:
+            raise self.error
+        self.tasks.put(functools.partial(fn, *args, **kwargs))
+
+    def close(self, raise_error=True):
+        # Waits for everything submitted so far.
+        if self.thread.is_alive():
+            self.tasks.put(None)
+            self.thread.join()
+        if raise_error and self.error is not None:
+            raise self.error
+
+# ---------- Build ----------
+def _init_worker(font_overrides):
+    FONT_OVERRIDES.update(font_overrides)
+
+def start_pool(jobs):
+    # A pool for build_batch(pool=...) whose workers are up with fonts loaded.
+    fonts = {bold: resolve_font(bold) for bold in (False, True)}
+    pool = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(fonts,))
+    list(pool.map(page_fonts, [TRIMS["8x10"]] * jobs))
+    return pool
+
+def _render_page_job(job, tracer=None, derivs=None):
+    # Returns (encoded page, Derived or None).
+    tracer = tracer or NULL_TRACER
+    spec, size_px, opts = job
+    derived = None
+    rows = strip_rows(size_px, opts)
+    with tracer.span("page", idx=spec.idx, size=f"{size_px[0]}x{size_px[1]}"):
+        if rows:
+            return _render_strips_job(spec, size_px, opts, rows, tracer, derivs)
+        page = render_spec(spec, size_px, opts, tracer)
+        if derivs:
+            derived = derive_page(page, spec, size_px, opts, derivs, tracer)
+        with tracer.span("encode") as sp:
+            out = page.finish() if isinstance(page, PdfCanvas) else encode_page(page, opts.encoding, opts.quality)
+            sp["bytes"] = len(out.data)
+        if not isinstance(page, PdfCanvas):
+            CANVASES.release(page)   # encoded and derived from; the next page draws on it
+    return out, derived
+
+def _render_strips_job(spec, size_px, opts, rows, tracer, derivs):
+    # Strip mode always encodes lossless Flate: JPEG can't be written a band
+    # at a time. The screen-size copy for derivatives is filled in per strip.
+    small = derivs and Image.new("RGB", screen_size(size_px, derivs), (255,255,255))
+
+    def strips():
+        for y0, strip in render_strips(spec, size_px, opts, rows, tracer):
+            if small:
+                sy0, sy1 = (round(y * small.height / size_px[1]) for y in (y0, y0 + strip.height))
+                if sy1 > sy0:
+                    small.paste(strip.resize((small.width, sy1 - sy0), Image.LANCZOS, reducing_gap=3.0), (0, sy0))
+            yield y0, strip
+
+    with tracer.span("strips") as sp:
+        out = encode_strips(strips(), size_px)
+        sp["bytes"] = len(out.data)
+    return out, derivs and derive_page(None, spec, size_px, opts, derivs, tracer, small=small)
+
+def _traced_render_job(job, memory=True, derivs=None):
+    # Pool workers trace locally and ship their events back with the page.
+    tracer = Tracer(memory=memory)
+    return _render_page_job(job, tracer, derivs), tracer.events
+
+def _windowed_map(pool, fn, items, window):
+    # Like pool.map(), which submits every task up front and holds each
+    # result in this process until it is read, but with at most `window`
+    # tasks ahead of the reader: a writer that falls behind (WriteQueue
+    # blocks) holds rendering back instead of letting pages pile up here.
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for fut in pending:
+            fut.cancel()
+
+# What build_batch() leaves behind for the next build of the same outputs
+# (see watch()): per PDF, the keys of the pages it holds and the PdfState of
+# the book and of its screen edition.
+BuiltBook = namedtuple("BuiltBook", "keys pdf screen")
+
+def _intact(path, state):
+    # The file is still exactly what we last wrote there.
+    return bool(state) and os.path.exists(path) and os.path.getsize(path) == state.length
+
+def pages_to_patch(path, screen_path, prev, keys, opts):
+    # Positions of the pages to patch into an existing PDF, or None for a
+    # full write. A patch needs the same page count and raster pages (vector
+    # pages share subset fonts); once superseded pages would make up half
+    # the file it is written afresh instead.
+    if not prev or len(prev.keys) != len(keys) or not _intact(path, prev.pdf):
+        return None
+    if screen_path and not _intact(screen_path, prev.screen):
+        return None
+    changed = [i for i, key in enumerate(keys) if key != prev.keys[i]]
+    if changed and (opts.backend != "raster" or prev.pdf.length >= 2 * prev.pdf.base):
+        return None
+    return changed
+
+def build_batch(books, jobs=1, cache_dir=CACHE_DIR, opts=RenderOptions(), tracer=None, derivs=None,
+                pool=None, previous=None, write_queue=WRITE_QUEUE):
+    # books: [(title, pages, targets), ...] with pages as (title, body, art)
+    # and targets as [(path, size_px), ...]. Each book's pages are described
+    # (text broken) once; every trim of every book then goes through one
+    # cache pass and one worker pool, so fonts, sprites and workers stay warm
+    # across titles. A page that several outputs share (same key, as in
+    # personalized variants) is rendered or loaded once. derivs (a Derivatives) adds web derivatives next to
+    # each PDF, cut from the same render pass.
+    #
+    # Returns {path: BuiltBook}. Passing that back as previous makes the next
+    # call patch existing PDFs in place with just the pages whose key
+    # changed (start a series with previous={}); pool reuses a running
+    # ProcessPoolExecutor. Writes go through a WriteQueue of write_queue tasks.
+    tracer = tracer or NULL_TRACER
+    # With neither a cache nor patching, keys only pair up outputs that
+    # share a page, and the job alone does that.
+    key_of = page_key if cache_dir or previous is not None else job_key
+    previous = previous or {}
+    if derivs and derivs.linearize and not (shutil.which("qpdf") or pikepdf):
+        print("Note: neither qpdf nor pikepdf is available; PDFs will not be linearized.")
+        derivs = derivs._replace(linearize=False)
+    outputs = []   # (path, title, first job, page count)
+    jobs_list = []
+    for title, pages, targets in books:
+        with tracer.span("describe", book=title, pages=len(pages)):
+            specs = [describe_page(idx, *page[:3], book=title) for idx, page in enumerate(pages, start=1)]
+        for path, size_px in targets:
+            outputs.append((path, title, len(jobs_list), len(specs)))
+            jobs_list += [(spec, size_px, opts) for spec in specs]
+    keys = [key_of(job) for job in jobs_list]
+    dkeys = [key and derivs and derived_key(key, derivs) for key in keys]
+
+    # Pages that go into a PDF this time: all of them, or only the changed
+    # ones where an output can be patched.
+    patches, needed = {}, []
+    for path, title, start, count in outputs:
+        screen_path = derivs and opts.backend == "raster" and derivative_paths(path, derivs)[0]
+        changed = pages_to_patch(path, screen_path, previous.get(path), keys[start:start + count], opts)
+        if changed is not None:
+            patches[path] = changed
+        needed += range(start, start + count) if changed is None else [start + i for i in changed]
+    # Later uses of a key take the first one's encoded page from reused.
+    uses = Counter(keys[k] for k in needed)
+    first = sorted({keys[k]: k for k in reversed(needed)}.values())   # each key's first job, in build order
+    dirty = [k for k in first if not cache_dir or not os.path.exists(cache_path(cache_dir, keys[k]))
+             or (dkeys[k] and not os.path.exists(cache_path(cache_dir, dkeys[k])))]
+    dirty_set = set(dirty)
+    reused = {}
+    render = functools.partial(_render_page_job, derivs=derivs)
+
+    def write_page(pdf, screen_pdf, thumb_dir, idx, key, dkey, pimg, derived, store):
+        if store:
+            cache_store(cache_dir, key, pimg)
+            if dkey:
+                cache_store_derived(cache_dir, dkey, derived)
+        with tracer.span("pdf.write", idx=idx) as sp:
+            pdf.add_page(pimg)
+            sp["bytes"] = len(pimg.data)
+        if derived:
+            if screen_pdf:
+                screen_pdf.add_page(derived.screen)
+            thumb = derived.thumb
+            write_if_changed(os.path.join(thumb_dir, f"page-{idx:03d}.{thumb.format}"), thumb.data)
+
+    def finish_book(path, pdf, screen_pdf, screen_path, thumb_dir, keys, changed, count, n):
+        with tracer.span("pdf.close"):
+            pdf.close()
+            if screen_pdf:
+                screen_pdf.close()
+        built[path] = BuiltBook(keys, pdf.state, screen_pdf.state if screen_pdf else None)
+        if changed is not None:
+            print(f"Patched {path} ({len(changed)} pages, {n} rendered)")
+        else:
+            print(f"{'Unchanged' if pdf.unchanged else 'Wrote'} {path}" + (f" ({n} rendered, {count - n} cached)" if cache_dir else ""))
+        pages = count if changed is None else len(changed)
+        if screen_pdf:
+            verb = "Patched" if changed is not None else "Unchanged" if screen_pdf.unchanged else "Wrote"
+            print(f"{verb} {screen_path} + {pages} thumbnails in {thumb_dir}")
+        elif thumb_dir:
+            print(f"Wrote {pages} thumbnails in {thumb_dir}")
+
+    built = {}
+    with ExitStack() as stack:
+        # Unwound in reverse: the writer stops before half-written files
+        # are cleaned up.
+        files = stack.enter_context(ExitStack())
+        writer = stack.enter_context(WriteQueue(write_queue))
+        if len(dirty) > 1 and (pool or jobs > 1):
+            # Pages are independent; results come back in order, at most
+            # `window` ahead of the writer.
+            if pool is None:
+                fonts = {bold: resolve_font(bold) for bold in (False, True)}
+                pool = stack.enter_context(ProcessPoolExecutor(max_workers=min(jobs, len(dirty)),
+                                                               initializer=_init_worker, initargs=(fonts,)))
+            window = 2 * max(jobs, 1)
+            if tracer.enabled:
+                traced = _windowed_map(pool, functools.partial(_traced_render_job, memory=tracer.memory, derivs=derivs),
+                                       (jobs_list[k] for k in dirty), window)
+                rendered = (tracer.extend(events) or out for out, events in traced)
+            else:
+                rendered = _windowed_map(pool, render, (jobs_list[k] for k in dirty), window)
+        else:
+            rendered = (render(jobs_list[k], tracer) for k in dirty)
+
+        # Jobs are grouped by output, so pages reach each book in order; a
+        # book is closed (on the writer) while the next one renders.
+        linearize = bool(derivs and derivs.linearize)
+        for path, title, start, count in outputs:
+            screen_path, thumb_dir = derivative_paths(path, derivs) if derivs else (None, None)
+            changed, prev = patches.get(path), previous.get(path)
+            if changed == []:
+                built[path] = prev
+                writer.submit(print, f"Unchanged {path}" + (f" (0 rendered, {count} cached)" if cache_dir else ""))
+                continue
+            if changed is None:
+                pdf = files.enter_context(PdfWriter(path, title=title, deterministic=opts.deterministic,
+                                                    linearize=linearize))
+                # A vector book is already web-sized, so it has no separate screen edition.
+                screen_pdf = screen_path and opts.backend == "raster" and files.enter_context(
+                    PdfWriter(screen_path, resolution=derivs.screen_dpi, title=title,
+                              deterministic=opts.deterministic, linearize=linearize))
+            else:
+                pdf = files.enter_context(PdfPatcher(path, prev.pdf, changed))
+                screen_pdf = screen_path and opts.backend == "raster" and files.enter_context(
+                    PdfPatcher(screen_path, prev.screen, changed, resolution=derivs.screen_dpi))
+            if thumb_dir:
+                os.makedirs(thumb_dir, exist_ok=True)
+            for k in (range(start, start + count) if changed is None else [start + i for i in changed]):
+                job, key, dkey = jobs_list[k], keys[k], dkeys[k]
+                pimg, derived = reused.get(key, (None, None))
+                store = False
+                if pimg is None and k not in dirty_set:
+                    with tracer.span("cache.load", idx=job[0].idx):
+                        pimg = cache_load(cache_dir, key)
+                        derived = dkey and cache_load_derived(cache_dir, dkey)
+                if pimg is None or (derivs and not derived):
+                    pimg, derived = next(rendered) if k in dirty_set else render(job, tracer)
+                    store = bool(cache_dir)
+                uses[key] -= 1
+                if uses[key]:
+                    reused[key] = pimg, derived
+                else:
+                    reused.pop(key, None)
+                writer.submit(write_page, pdf, screen_pdf, thumb_dir, job[0].idx, key, dkey, pimg, derived, store)
+            n = sum(1 for k in range(start, start + count) if k in dirty_set)
+            writer.submit(finish_book, path, pdf, screen_pdf, screen_path, thumb_dir,
+                          tuple(keys[start:start + count]), changed, count, n)
+    return built
+
+def build_books(targets, jobs=1, cache_dir=CACHE_DIR, pages=None, tracer=None, title=None, derivs=None, **options):
+    # One book, several trims. pages (default PAGES, looked up per call so
+    # watch edits count) may be (title, body) pairs (art from PAGE_ART) or
+    # (title, body, art) triples; options are RenderOptions fields.
+    pages = PAGES if pages is None else pages
+    return build_batch([(title, pages, targets)], jobs=jobs, cache_dir=cache_dir, opts=RenderOptions(**options),
+                       tracer=tracer, derivs=derivs)
+
+def make_book(path, size_px, **kwargs):
+    build_books([(path, size_px)], **kwargs)
+
+def book_targets(book, out_dir=BOOKS_DIR, trims=None):
+    names = trims or list(book.trims)
+    return [(os.path.join(out_dir, f"{book.output}_{name}.pdf"), book.trims.get(name) or TRIMS[name]) for name in names]
+
+# ---------- Watch ----------
+# Module-level names reload_code leaves alone: book content it swaps in
+# wholesale, and state the command line sets up (--font).
+RELOAD_CONTENT = ("PAGES", "PAGE_ART", "ART_PRIMITIVES")
+RELOAD_KEEP = ("FONT_OVERRIDES",)
+
+def _rebind(fn):
+    return types.FunctionType(fn.__code__, globals(), fn.__name__, fn.__defaults__)
+
+def _value_sig(v):
+    # A comparable stand-in for a module-level value: data as itself,
+    # functions by their code (closures included), None for other objects.
+    if isinstance(v, (int, float, str, bytes, type(None))):
+        return v
+    if isinstance(v, (tuple, list)):
+        return type(v).__name__, tuple(map(_value_sig, v))
+    if isinstance(v, dict):
+        return "dict", tuple((k, _value_sig(x)) for k, x in v.items())
+    if isinstance(v, (set, frozenset)):
+        return "set", tuple(sorted(map(repr, v)))
+    if inspect.isfunction(v):
+        return _function_sig(v), tuple(_value_sig(c.cell_contents) for c in v.__closure__ or ())
+    if isinstance(v, re.Pattern):
+        return v.pattern, v.flags
+    return None
+
+def reload_code(path=__file__):
+    # Re-runs this file in a scratch namespace and swaps what changed into
+    # the running module: book content (RELOAD_CONTENT) and functions.
+    # An lru_cached function is swapped in with an empty cache, and every
+    # other module cache is dropped too: any may hold its old results.
+    # Classes and module constants can't be swapped (instances
+    # and values computed from them stay behind), so an edit to one leaves
+    # the module as it was and asks for a restart.
+    # Returns "content" (pages only), "code" (functions swapped: restart
+    # the pool) or "restart".
+    ns = {"__name__": "_spider_reload", "__file__": path}
+    with open(path, encoding="utf-8") as f:
+        exec(compile(f.read(), path, "exec"), ns)
+    g = globals()
+    own = lambda v: getattr(v, "__module__", None) == ns["__name__"]
+    swap, cached, stuck = {}, False, []
+    for name, val in ns.items():
+        if name.startswith("__") or name in RELOAD_CONTENT + RELOAD_KEEP or inspect.ismodule(val):
+            continue
+        old = g.get(name)
+        if inspect.isfunction(val) and own(val):
+            if not inspect.isfunction(old) or _function_sig(old) != _function_sig(val):
+                swap[name] = _rebind(val)
+        elif hasattr(val, "cache_info") and own(val.__wrapped__):
+            if (not hasattr(old, "cache_info") or _function_sig(old.__wrapped__) != _function_sig(val.__wrapped__)
+                    or old.cache_parameters() != val.cache_parameters()):
+                swap[name] = functools.lru_cache(**val.cache_parameters())(_rebind(val.__wrapped__))
+                cached = True
+        elif inspect.isclass(val) and own(val):
+            if not inspect.isclass(old) or _object_digest.__wrapped__(old)[0] != _object_digest.__wrapped__(val)[0]:
+                stuck.append(name)
+        elif name not in g:
+            swap[name] = val
+        elif not callable(val) and _value_sig(val) is not None and _value_sig(val) != _value_sig(old):
+            stuck.append(name)
+    if stuck:
+        print(f"Changed {', '.join(stuck)}, which can't be swapped into the running build.")
+        return "restart"
+    g.update(swap)
+    g["PAGES"], g["PAGE_ART"] = ns["PAGES"], ns["PAGE_ART"]
+    old_art = {name: _function_sig(fn) for name, fn in ART_PRIMITIVES.items()}
+    g["ART_PRIMITIVES"] = {name: g[fn.__name__] if ns.get(fn.__name__) is fn else _rebind(fn)
+                           for name, fn in ns["ART_PRIMITIVES"].items()}
+    if not swap and old_art == {name: _function_sig(fn) for name, fn in ART_PRIMITIVES.items()}:
+        return "content"
+    # Fingerprints and sprites hold what the old code hashed or drew.
+    caches = [code_fingerprint, _accepts]
+    if cached:
+        caches = [v for v in g.values() if hasattr(v, "cache_clear") and getattr(v, "__module__", None) == __name__]
+    for fn in caches:
+        fn.cache_clear()
+    SPRITES.clear()
+    return "code"
+
+def watch(manifests, out_dir, trims=None, jobs=1, cache_dir=CACHE_DIR, opts=RenderOptions(), derivs=None, interval=0.25):
+    # Rebuilds whenever this file or one of the manifests is saved. Fonts,
+    # layout measurements and the worker pool stay warm between builds, and
+    # only pages whose key changed are rendered and patched into the PDFs.
+    # A code edit (not a content one) restarts the pool so workers pick it up;
+    # one reload_code can't swap in restarts the whole process, so no page
+    # is ever drawn (and cached) by old code under a new key.
+    files = [os.path.abspath(__file__)] + [os.path.abspath(m) for m in manifests]
+    stamp = lambda: {f: os.stat(f).st_mtime_ns for f in files if os.path.exists(f)}
+    seen, previous, pool = None, {}, None
+    try:
+        while True:
+            now = stamp()
+            if now != seen:
+                t0 = time.perf_counter()
+                try:
+                    reloaded = seen is not None and now.get(files[0]) != seen.get(files[0]) and reload_code(files[0])
+                    if reloaded == "restart":
+                        print("Restarting...", flush=True)
+                        if pool:
+                            pool.shutdown()
+                        os.execv(sys.executable, [sys.executable] + sys.argv)
+                    if reloaded == "code" and pool:
+                        pool.shutdown()
+                        pool = None
+                    seen = now
+                    books = [load_manifest(m) for m in manifests] or [builtin_book()]
+                    if pool is None and jobs > 1:
+                        pool = start_pool(jobs)
+                    previous = build_batch([(b.title, b.pages, book_targets(b, out_dir, trims)) for b in books],
+                                           jobs=jobs, cache_dir=cache_dir, opts=opts, derivs=derivs,
+                                           pool=pool, previous=previous)
+                    print(f"Built in {time.perf_counter() - t0:.2f}s; watching for changes (Ctrl-C to stop)")
+                except Exception as e:   # a half-finished edit shouldn't end the session
+                    seen = now
+                    print("".join(traceback.format_exception_only(type(e), e)).rstrip())
+                    print("Build failed; fix it and save again.")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print()
+    finally:
+        if pool:
+            pool.shutdown()
 
 if __name__ == "__main__":
-    # 8.5" x 8.5" @ 300DPI -> 2550 x 2550
-    make_book(os.path.join(BOOKS_DIR, "Spiders_Eight_Legs_of_Awesome_8p5x8p5.pdf"), (2550,2550))
-    # 8" x 10" @ 300DPI -> 2400 x 3000
-    make_book(os.path.join(BOOKS_DIR, "Spiders_Eight_Legs_of_Awesome_8x10.pdf"), (2400,3000))
-    print("All done. Replace the PDFs in /books and refresh your site.")
+    ap = argparse.ArgumentParser(description="Build the Spider Quest picture books into ./books.")
+    ap.add_argument("--jobs", type=int, default=1, help="render pages in N worker processes (0 = one per CPU)")
+    ap.add_argument("--cache-dir", default=CACHE_DIR, help="where rendered pages are cached between runs")
+    ap.add_argument("--no-cache", action="store_true", help="re-render every page and leave the cache alone")
+    ap.add_argument("--backend", choices=("raster", "vector"), default="raster",
+                    help="raster: 300 DPI page images (default); vector: PDF paths and embedded text")
+    ap.add_argument("--trims", type=lambda v: v.split(","), default=None,
+                    help="comma-separated trim sizes to emit: " + ", ".join(TRIMS) + " (default: the book's own)")
+    ap.add_argument("--manifest", action="append", help="build the book described by this JSON/TOML/YAML manifest (repeatable)")
+    ap.add_argument("--batch", help="build every manifest in this directory in one job")
+    ap.add_argument("--variants", help="build a personalized copy of the book per reader in this file (.txt: a name per "
+                                       "line; .csv/.json: fields) into personalized/; {name} etc. fill the Cover and The End")
+    ap.add_argument("--out-dir", help="where PDFs are written (default: books/, or personalized/ with --variants)")
+    ap.add_argument("--dump-manifest", help="write the (first) book as a JSON manifest and exit")
+    ap.add_argument("--art-backend", choices=("draw", "numpy"), default="draw",
+                    help="numpy: draw webs, petals, sheet lines and gradients as array passes (needs NumPy)")
+    ap.add_argument("--supersample", type=int, default=1, choices=range(1, 9), metavar="N",
+                    help="anti-alias the art panel by drawing it at N x (2-4 is plenty) and scaling down")
+    ap.add_argument("--encoding", choices=ENCODINGS, default="jpeg",
+                    help="raster page encoding: jpeg (default), flate, palette, or auto (smallest per page)")
+    ap.add_argument("--quality", type=int, default=75, help="JPEG quality for --encoding jpeg/auto")
+    ap.add_argument("--strip-rows", type=int, default=0,
+                    help=f"render raster pages in strips of N rows (lossless; default: only pages over {STRIP_AUTO_PIXELS/1e6:g} MP)")
+    ap.add_argument("--deterministic", action="store_true",
+                    help="seeded art + fixed PDF metadata: identical inputs give byte-identical PDFs (dates from SOURCE_DATE_EPOCH)")
+    ap.add_argument("--derivatives", action="store_true",
+                    help="also write page thumbnails, a low-DPI screen edition and linearized PDFs for the web")
+    ap.add_argument("--thumb-width", type=int, default=320, help="thumbnail width in px (with --derivatives)")
+    ap.add_argument("--thumb-format", choices=("webp", "png"), default="webp", help="thumbnail format (with --derivatives)")
+    ap.add_argument("--screen-dpi", type=int, default=96, help="screen edition resolution; 0 = skip it (with --derivatives)")
+    ap.add_argument("--no-precache", action="store_true",
+                    help=f"don't (re)write {PRECACHE_MANIFEST} (hashes + sizes of every book artifact) in --out-dir")
+    ap.add_argument("--watch", action="store_true",
+                    help="keep running: on every save of this file or a manifest, re-render changed pages and patch them into the PDFs")
+    ap.add_argument("--trace", help="record per-stage spans and write a Chrome trace (JSON) here")
+    ap.add_argument("--font", help="TrueType/OpenType file for regular text")
+    ap.add_argument("--font-bold", help="TrueType/OpenType file for titles")
+    ap.add_argument("--strict-fonts", action="store_true", help="fail instead of falling back to Pillow's built-in font")
+    args = ap.parse_args()
+    args.trims_given = args.trims is not None
+    args.trims = args.trims or ["8p5x8p5", "8x10"]
+    for name in args.trims:
+        if name not in TRIMS:
+            ap.error(f"unknown trim {name!r} (choose from {', '.join(TRIMS)})")
+    if args.variants and args.watch:
+        ap.error("--variants can't be combined with --watch")
+    jobs = args.jobs or os.cpu_count() or 1
+    FONT_OVERRIDES.update({False: args.font or FONT_OVERRIDES[False], True: args.font_bold or FONT_OVERRIDES[True]})
+
+    fonts = font_report()
+    print("Fonts:", ", ".join(f"{k}={v}" for k, v in fonts.items()))
+    if not all(resolve_font(bold) for bold in (False, True)):
+        if args.strict_fonts:
+            raise SystemExit("No TrueType font found; pass --font/--font-bold or set SPIDER_FONT_DIRS.")
+        print("Warning: no TrueType font found, falling back to Pillow's built-in font.")
+    cache_dir = None if args.no_cache else args.cache_dir
+    if args.art_backend == "numpy" and np is None:
+        raise SystemExit("--art-backend numpy needs NumPy (pip install numpy).")
+
+    args.out_dir = args.out_dir or (VARIANTS_DIR if args.variants else BOOKS_DIR)
+    try:
+        manifests = (args.manifest or []) + (find_manifests(args.batch) if args.batch else [])
+        books = [load_manifest(m) for m in manifests] or [personal_book() if args.variants else builtin_book()]
+        variants = load_variants(args.variants) if args.variants else None
+    except (OSError, ValueError) as e:
+        raise SystemExit(str(e))
+    if args.dump_manifest:
+        with open(args.dump_manifest, "w", encoding="utf-8") as f:
+            json.dump(dump_manifest(books[0]), f, indent=2, ensure_ascii=False)
+        raise SystemExit(f"Wrote {args.dump_manifest}")
+
+    opts = RenderOptions(backend=args.backend, encoding=args.encoding, quality=args.quality,
+                         deterministic=args.deterministic, strip_rows=args.strip_rows, art_backend=args.art_backend,
+                         supersample=args.supersample)
+    tracer = Tracer() if args.trace else None
+    os.makedirs(args.out_dir, exist_ok=True)
+    trims = args.trims if not manifests or args.trims_given else None
+    derivs = Derivatives(args.thumb_width, args.thumb_format, args.screen_dpi) if args.derivatives else None
+    if args.watch:
+        # Patched PDFs can't stay linearized; run a normal build before publishing.
+        watch(manifests, args.out_dir, trims, jobs=jobs, cache_dir=cache_dir, opts=opts,
+              derivs=derivs and derivs._replace(linearize=False))
+    else:
+        try:
+            batch = [entry for b in books for entry in variant_books(b, variants, args.out_dir, trims)] if variants \
+                else [(b.title, b.pages, book_targets(b, args.out_dir, trims)) for b in books]
+        except ValueError as e:
+            raise SystemExit(str(e))
+        build_batch(batch, jobs=jobs, cache_dir=cache_dir, opts=opts, tracer=tracer, derivs=derivs)
+    # Personalized copies are print jobs, not site artifacts.
+    if not args.no_precache and not variants:
+        write_precache_manifest(args.out_dir)
+    if tracer:
+        for name, t in sorted(tracer.summary().items(), key=lambda kv: -kv[1]["dur_us"]):
+            print(f"  {name:12s} x{t['count']:<4d} {t['dur_us']/1000:10.1f} ms  {t['alloc']/1e6:8.1f} MB heap")
+        tracer.write_chrome_trace(args.trace)
+        print("Wrote", args.trace)
+    print(f"All done. {len(variants)} personalized copies in {args.out_dir}." if variants
+          else "All done. Replace the PDFs in /books and refresh your site.")
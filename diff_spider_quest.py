@@ -0,0 +1,250 @@
+# diff_spider_quest.py
+# Page-by-page visual regression check for the built PDFs. `record` stores,
+# per page, a hash of the page's image stream, a 64-bit dHash and a 32x32
+# thumbnail (plus a copy of each PDF); `compare` checks a new build against
+# that in three steps, each only for the pages the previous one couldn't
+# clear:
+#   1. same image stream bytes                  -> identical, nothing decoded
+#   2. same fingerprint (dHash + thumbnail)     -> "subtle": changed, but below what 32x32 can see
+#   3. fingerprint mismatch                     -> full-resolution diff, heatmap PNG
+# JPEG pages are fingerprinted from a 1/8-scale draft decode, so steps 1-2
+# stay cheap for hundreds of pages; Flate pages have to be inflated.
+#
+# Usage:
+#   python diff_spider_quest.py record                 # books/ -> .spider_baseline/
+#   python diff_spider_quest.py compare                # exit 1 if any page changed; heatmaps in .spider_diff/
+#   python diff_spider_quest.py compare /tmp/out --threshold 24
+
+import os, io, re, sys, json, zlib, base64, shutil, struct, hashlib, argparse
+from PIL import Image, ImageChops, ImageFilter
+
+import build_spider_quest as bsq
+
+BASELINE_DIR = os.path.join(bsq.ROOT, ".spider_baseline")
+DIFF_DIR = os.path.join(bsq.ROOT, ".spider_diff")
+FINGERPRINTS = "fingerprints.json"
+THUMB = 32           # fingerprint thumbnail edge, px
+HEATMAP_WIDTH = 1000
+
+# ---------- Reading Page Images ----------
+# Enough PDF to get the page images back out of what PdfWriter wrote
+# (patched or linearized too): objects are read front to back and a later
+# definition replaces an earlier one, as in an incremental update.
+OBJ = re.compile(rb"(\d+) 0 obj\s*")
+
+def _dict_end(data, pos):
+    # Index just past the << ... >> starting at pos (hex strings skipped).
+    depth = 0
+    while True:
+        if data.startswith(b"<<", pos):
+            depth, pos = depth + 1, pos + 2
+        elif data.startswith(b">>", pos):
+            depth, pos = depth - 1, pos + 2
+            if depth == 0:
+                return pos
+        elif data[pos:pos+1] == b"<":
+            pos = data.index(b">", pos) + 1
+        else:
+            pos += 1
+
+def pdf_objects(data):
+    # {object id: (dictionary bytes, stream bytes or None)}
+    objs, pos = {}, 0
+    while m := OBJ.search(data, pos):
+        oid, pos = int(m[1]), m.end()
+        end = _dict_end(data, pos) if data.startswith(b"<<", pos) else data.index(b"endobj", pos)
+        body, stream = data[pos:end], None
+        s = re.compile(rb"\s*stream\r?\n").match(data, end)
+        if s:
+            length = re.search(rb"/Length (\d+)(?! \d+ R)", body)
+            stop = s.end() + int(length[1]) if length else data.index(b"endstream", s.end())
+            stream, end = data[s.end():stop], stop
+        objs[oid] = (body, stream)
+        pos = end
+    return objs
+
+def _ref(body, key):
+    m = re.search(rb"/" + key + rb"\s+(\d+) 0 R", body)
+    return m and int(m[1])
+
+def page_objects(objs):
+    # Page dictionaries in reading order, following /Kids from the catalog.
+    catalog = next(body for body, _ in objs.values() if re.search(rb"/Type\s*/Catalog", body))
+    pages, todo = [], [_ref(catalog, b"Pages")]
+    while todo:
+        body = objs[todo.pop(0)][0]
+        kids = re.search(rb"/Kids\s*\[([^\]]*)\]", body)
+        if kids:
+            todo[:0] = [int(k) for k in re.findall(rb"(\d+) 0 R", kids[1])]
+        else:
+            pages.append(body)
+    return pages
+
+def _png(width, height, bpc, colorspace, idat):
+    # A PNG file around a FlateDecode + /Predictor 15 stream (the inverse of bsq._png_parts).
+    def chunk(kind, payload):
+        return struct.pack(">I", len(payload)) + kind + payload + struct.pack(">I", zlib.crc32(kind + payload))
+    indexed = re.search(rb"/Indexed\s*/DeviceRGB\s*\d+\s*<([0-9a-fA-F\s]*)>", colorspace)
+    ctype = 3 if indexed else 0 if b"DeviceGray" in colorspace else 2
+    png = b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, bpc, ctype, 0, 0, 0))
+    if indexed:
+        png += chunk(b"PLTE", bytes.fromhex(indexed[1].decode().replace(" ", "").replace("\n", "")))
+    return png + chunk(b"IDAT", idat) + chunk(b"IEND", b"")
+
+def page_images(path):
+    # [(stream digest, opener or None)] per page: opener(scale) decodes the
+    # page image at 1/scale (or near it; JPEG skips the full-size decode). Pages
+    # without an image (vector backend) only get a digest of their content.
+    with open(path, "rb") as f:
+        objs = pdf_objects(f.read())
+    out = []
+    for page in page_objects(objs):
+        resources = page
+        if not re.search(rb"/Resources\s*<<", page):
+            resources = objs[_ref(page, b"Resources")][0]
+        img_id = re.search(rb"/XObject\s*<<\s*/\w+\s+(\d+) 0 R", resources)
+        if not img_id:
+            out.append((hashlib.sha256(objs[_ref(page, b"Contents")][1]).hexdigest(), None))
+            continue
+        body, data = objs[int(img_id[1])]
+        out.append((hashlib.sha256(data).hexdigest(), _opener(body, data)))
+    return out
+
+def _opener(body, data):
+    num = lambda key: int(re.search(rb"/" + key + rb"\s+(\d+)", body)[1])
+    def open_image(scale=1):
+        if b"/DCTDecode" in body:
+            img = Image.open(io.BytesIO(data))
+            if scale > 1:
+                img.draft(img.mode, (img.width // scale, img.height // scale))
+        else:
+            colorspace = re.search(rb"/ColorSpace\s*(\[[^\]]*\]|/\w+)", body)[1]
+            img = Image.open(io.BytesIO(_png(num(b"Width"), num(b"Height"), num(b"BitsPerComponent"), colorspace, data)))
+            if scale > 1:
+                return img.convert("RGB").reduce(scale)
+        return img.convert("RGB")
+    return open_image
+
+# ---------- Fingerprints ----------
+def dhash(img):
+    # 64-bit difference hash: is each of 8x8 cells brighter than its right neighbour.
+    px = img.convert("L").resize((9, 8), Image.BOX).tobytes()
+    bits = [px[r*9 + c] > px[r*9 + c + 1] for r in range(8) for c in range(8)]
+    return f"{sum(1 << i for i, b in enumerate(bits) if b):016x}"
+
+def fingerprint(digest, opener):
+    fp = {"stream": digest}
+    if opener:
+        img = opener(8)
+        fp["dhash"] = dhash(img)
+        fp["thumb"] = base64.b64encode(img.resize((THUMB, THUMB), Image.BOX).tobytes()).decode()
+    return fp
+
+def fingerprints_match(a, b, tolerance):
+    # Same dHash and no thumbnail channel further apart than tolerance.
+    if "thumb" not in a or "thumb" not in b or a["dhash"] != b["dhash"]:
+        return False
+    ta, tb = (Image.frombytes("RGB", (THUMB, THUMB), base64.b64decode(fp["thumb"])) for fp in (a, b))
+    return max(hi for _, hi in ImageChops.difference(ta, tb).getextrema()) <= tolerance
+
+def hamming(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+def book_pdfs(books_dir):
+    return sorted(f for f in os.listdir(books_dir) if f.lower().endswith(".pdf"))
+
+def record(books_dir, baseline_dir):
+    os.makedirs(baseline_dir, exist_ok=True)
+    books = {}
+    for name in book_pdfs(books_dir):
+        src = os.path.join(books_dir, name)
+        books[name] = [fingerprint(*page) for page in page_images(src)]
+        # kept for heatmaps: a mismatch is diffed against the recorded pixels
+        shutil.copyfile(src, os.path.join(baseline_dir, name + ".tmp"))
+        os.replace(os.path.join(baseline_dir, name + ".tmp"), os.path.join(baseline_dir, name))
+        print(f"Recorded {name} ({len(books[name])} pages)")
+    bsq.write_if_changed(os.path.join(baseline_dir, FINGERPRINTS), (json.dumps({"books": books}) + "\n").encode())
+    return books
+
+# ---------- Heatmaps ----------
+def diff_mask(a, b, threshold):
+    # Pixels where any channel moved by more than threshold (white in an "L" mask).
+    if a.size != b.size:
+        b = b.resize(a.size, Image.BILINEAR)
+    diff = ImageChops.difference(a, b).split()
+    return ImageChops.lighter(ImageChops.lighter(*diff[:2]), diff[2]).point(lambda v: 255 if v > threshold else 0)
+
+def heatmap(img, mask):
+    # The new page washed out to light gray, changed pixels in red.
+    scale = min(1.0, HEATMAP_WIDTH / img.width)
+    size = (round(img.width * scale), round(img.height * scale))
+    base = img.resize(size, Image.BOX).convert("L").point(lambda v: 160 + v * 95 // 255).convert("RGB")
+    # any changed pixel marks its whole downscaled cell, grown a little to stay visible
+    mask = mask.resize(size, Image.BOX).point(lambda v: 255 if v else 0).filter(ImageFilter.MaxFilter(3))
+    return Image.composite(Image.new("RGB", size, (230, 20, 20)), base, mask)
+
+def compare(books_dir, baseline_dir, diff_dir, threshold=16, tolerance=0):
+    # Prints a report and returns the number of changed pages (incl. added/removed ones).
+    with open(os.path.join(baseline_dir, FINGERPRINTS)) as f:
+        baseline = json.load(f)["books"]
+    changed = 0
+    for name in sorted(set(book_pdfs(books_dir)) | set(baseline)):
+        if name not in baseline or not os.path.exists(os.path.join(books_dir, name)):
+            print(f"{name}: {'new' if name not in baseline else 'missing'} (not in {'baseline' if name not in baseline else books_dir})")
+            changed += 1
+            continue
+        old_pages, new_pages = baseline[name], page_images(os.path.join(books_dir, name))
+        old_images = None
+        counts = {"identical": 0, "subtle": 0, "changed": 0}
+        lines = []
+        for n, ((digest, opener), old) in enumerate(zip(new_pages, old_pages), start=1):
+            if digest == old["stream"]:
+                counts["identical"] += 1
+                continue
+            fp = fingerprint(digest, opener)
+            if fingerprints_match(fp, old, tolerance):
+                counts["subtle"] += 1
+                lines.append(f"  page {n}: subtle (stream changed, fingerprint the same)")
+                continue
+            counts["changed"] += 1
+            if not opener or "thumb" not in old:
+                lines.append(f"  page {n}: changed (vector page, not rasterized)")
+                continue
+            old_images = old_images or page_images(os.path.join(baseline_dir, name))
+            new_img = opener()
+            mask = diff_mask(new_img, old_images[n - 1][1](), threshold)
+            share = mask.histogram()[255] / (mask.width * mask.height)
+            out = os.path.join(diff_dir, os.path.splitext(name)[0], f"page-{n:03d}.png")
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            heatmap(new_img, mask).save(out)
+            lines.append(f"  page {n}: changed, {share:.2%} of pixels in {mask.getbbox()}, "
+                         f"dHash distance {hamming(fp['dhash'], old['dhash'])} -> {out}")
+        extra = len(new_pages) - len(old_pages)
+        if extra:
+            lines.append(f"  {abs(extra)} page(s) {'added' if extra > 0 else 'removed'} at the end")
+        changed += counts["changed"] + counts["subtle"] + abs(extra)
+        print(f"{name}: {len(new_pages)} pages, " + ", ".join(f"{v} {k}" for k, v in counts.items()))
+        for line in lines:
+            print(line)
+    return changed
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Per-page visual regression check for Spider Quest PDFs.")
+    ap.add_argument("command", choices=("record", "compare"))
+    ap.add_argument("books_dir", nargs="?", default=bsq.BOOKS_DIR, help="folder of built PDFs (default: books/)")
+    ap.add_argument("--baseline", default=BASELINE_DIR, help="where fingerprints and baseline PDFs are kept")
+    ap.add_argument("--diff-dir", default=DIFF_DIR, help="where compare writes heatmaps")
+    ap.add_argument("--threshold", type=int, default=16,
+                    help="per-channel difference that counts as a changed pixel in heatmaps (JPEG noise sits below it)")
+    ap.add_argument("--tolerance", type=int, default=0,
+                    help="largest thumbnail channel difference still treated as the same fingerprint")
+    args = ap.parse_args()
+
+    if args.command == "record":
+        record(args.books_dir, args.baseline)
+    else:
+        if not os.path.exists(os.path.join(args.baseline, FINGERPRINTS)):
+            raise SystemExit(f"No baseline in {args.baseline}; run `record` first.")
+        n = compare(args.books_dir, args.baseline, args.diff_dir, args.threshold, args.tolerance)
+        print(f"{n} page(s) changed." if n else "No page changed.")
+        sys.exit(1 if n else 0)
@@ -0,0 +1,261 @@
+# serve_spider_quest.py
+# A long-lived render service for on-demand books. Fonts, sprites, the page
+# cache and the worker pool stay warm between requests, so a book costs only
+# the pages that aren't cached yet. Identical requests in flight share one
+# render, and finished PDFs are kept in an LRU bounded by --cache-mb.
+#
+#   GET  /book?trim=8x10     the built-in book
+#   POST /book?trim=8x10     a JSON book manifest (see build_spider_quest.py) as the body
+#        optional: &encoding=flate &quality=85 &backend=vector &supersample=2
+#   GET  /stats              request and cache counters as JSON
+#
+# PDFs are rendered deterministically and the ETag is a hash of the request,
+# so If-None-Match is answered without rendering.
+#
+# Usage:
+#   python serve_spider_quest.py --port 8765 --jobs 4
+#   python serve_spider_quest.py --socket /tmp/spider_quest.sock
+#   curl -o book.pdf 'http://127.0.0.1:8765/book?trim=8x10'
+#   curl --unix-socket /tmp/spider_quest.sock --data-binary @manifests/spiders_eight_legs_of_awesome.json \
+#        -o book.pdf 'http://localhost/book?trim=A4'
+
+import os, json, stat, hashlib, argparse, tempfile, threading, socketserver
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import build_spider_quest as bsq
+
+MAX_BODY = 4 << 20   # largest manifest accepted, in bytes
+MAX_PAGES = 100      # pages per requested book
+MAX_TRIM_PIXELS = max(w * h for w, h in bsq.TRIMS.values())   # no page bigger than the largest named trim
+
+class ResultCache:
+    # Finished PDFs by request key; least recently used go first once the
+    # total passes max_bytes. Not locked: RenderService holds its lock.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.bytes = 0
+
+    def get(self, key):
+        data = self.items.get(key)
+        if data is not None:
+            self.items.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if key in self.items or len(data) > self.max_bytes:
+            return
+        self.items[key] = data
+        self.bytes += len(data)
+        while self.bytes > self.max_bytes:
+            _, old = self.items.popitem(last=False)
+            self.bytes -= len(old)
+
+def parse_request(query, body):
+    # (book, trim name, size_px, RenderOptions) from the query string and an
+    # optional JSON manifest; ValueError for anything malformed or too big
+    # to render while other requests wait (art parameters are checked by
+    # parse_manifest).
+    q = {k: v[-1] for k, v in parse_qs(query).items()}
+    try:
+        data = json.loads(body) if body else None
+    except RecursionError:
+        raise ValueError("manifest is nested too deeply")
+    book = bsq.parse_manifest(data, "request") if body else bsq.builtin_book()
+    if len(book.pages) > MAX_PAGES:
+        raise ValueError(f"{len(book.pages)} pages is over the limit of {MAX_PAGES}")
+    trim = q.get("trim") or next(iter(book.trims))
+    size_px = book.trims.get(trim) or bsq.TRIMS.get(trim)
+    if not size_px:
+        raise ValueError(f"unknown trim {trim!r} (choose from {', '.join(dict(bsq.TRIMS, **book.trims))})")
+    if size_px[0] * size_px[1] > MAX_TRIM_PIXELS:
+        raise ValueError(f"trim {trim!r} is {size_px[0]}x{size_px[1]} px, over the limit of {MAX_TRIM_PIXELS} pixels")
+    if min(size_px) < bsq.MIN_TRIM_PX:
+        raise ValueError(f"trim {trim!r} is {size_px[0]}x{size_px[1]} px; pages need {bsq.MIN_TRIM_PX} px a side")
+    backend = q.get("backend", "raster")
+    encoding = q.get("encoding", "jpeg")
+    if backend not in ("raster", "vector"):
+        raise ValueError(f"unknown backend {backend!r} (choose from raster, vector)")
+    if encoding not in bsq.ENCODINGS:
+        raise ValueError(f"unknown encoding {encoding!r} (choose from {', '.join(bsq.ENCODINGS)})")
+    quality, supersample = int(q.get("quality", 75)), int(q.get("supersample", 1))
+    if not 1 <= quality <= 95 or not 1 <= supersample <= 8:
+        raise ValueError("quality must be 1-95 and supersample 1-8")
+    opts = bsq.RenderOptions(backend=backend, encoding=encoding, quality=quality, deterministic=True,
+                             supersample=supersample)
+    return book, trim, tuple(size_px), opts
+
+class RenderService:
+    def __init__(self, jobs=1, cache_dir=bsq.CACHE_DIR, cache_bytes=256 << 20):
+        self.jobs = jobs
+        self.cache_dir = cache_dir
+        self.results = ResultCache(cache_bytes)
+        self.inflight = {}                   # request key -> Future of the PDF bytes
+        self.lock = threading.Lock()         # guards results, inflight and counters
+        self.render_lock = threading.Lock()  # one build at a time; each already fans out to the whole pool
+        self.counters = {"requests": 0, "hits": 0, "coalesced": 0, "rendered": 0, "errors": 0}
+        self.pool = bsq.start_pool(jobs) if jobs > 1 else None
+        for size in bsq.builtin_book().trims.values():
+            bsq.page_fonts(size)
+        # What the renderer is: a new build or different fonts change every
+        # PDF, so they change every ETag too.
+        self.renderer = json.dumps([bsq.BUILDER_VERSION, bsq.code_fingerprint(bsq._render_page_job),
+                                    {name: bsq.code_fingerprint(fn) for name, fn in bsq.ART_PRIMITIVES.items()},
+                                    bsq.font_report()], sort_keys=True)
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, cached=len(self.results.items), cached_bytes=self.results.bytes,
+                        inflight=len(self.inflight))
+
+    def request_key(self, book, size_px, opts):
+        blob = json.dumps([self.renderer, bsq.dump_manifest(book), size_px, opts], sort_keys=True)
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def book_pdf(self, book, size_px, opts, key=None):
+        # (PDF bytes, how): how is "hit", "coalesced" (waited on someone
+        # else's render of the same request) or "rendered".
+        key = key or self.request_key(book, size_px, opts)
+        with self.lock:
+            self.counters["requests"] += 1
+            data = self.results.get(key)
+            if data is not None:
+                self.counters["hits"] += 1
+                return data, "hit"
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+            else:
+                self.counters["coalesced"] += 1
+        if not owner:
+            return future.result(), "coalesced"
+        try:
+            data = self.render(book, size_px, opts)
+        except BaseException as e:
+            with self.lock:
+                self.counters["errors"] += 1
+                del self.inflight[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self.counters["rendered"] += 1
+            self.results.put(key, data)
+            del self.inflight[key]
+        future.set_result(data)
+        return data, "rendered"
+
+    def render(self, book, size_px, opts):
+        with self.render_lock, tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "book.pdf")
+            bsq.build_batch([(book.title, book.pages, [(path, size_px)])], jobs=self.jobs,
+                            cache_dir=self.cache_dir, opts=opts, pool=self.pool)
+            with open(path, "rb") as f:
+                return f.read()
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = f"SpiderQuest/{bsq.BUILDER_VERSION}"
+
+    def address_string(self):
+        # Unix-socket peers have no address.
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def do_GET(self):
+        self.route(None)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            return self.reply(400, "bad Content-Length\n")
+        if length > MAX_BODY:
+            return self.reply(413, f"manifest over {MAX_BODY} bytes\n")
+        self.route(self.rfile.read(length))
+
+    def route(self, body):
+        url = urlsplit(self.path)
+        if url.path == "/stats":
+            return self.reply(200, json.dumps(self.server.service.stats(), indent=2) + "\n", "application/json")
+        if url.path != "/book":
+            return self.reply(404, "not found\n")
+        service = self.server.service
+        try:
+            book, trim, size_px, opts = parse_request(url.query, body)
+        except ValueError as e:
+            return self.reply(400, f"{e}\n")
+        key = service.request_key(book, size_px, opts)
+        etag = f'"{key}"'
+        if etag in self.headers.get("If-None-Match", ""):
+            return self.reply(304, b"", headers={"ETag": etag})
+        try:
+            data, how = service.book_pdf(book, size_px, opts, key)
+        except Exception as e:
+            self.log_error("render failed: %r", e)
+            return self.reply(500, f"render failed: {e}\n")
+        name = os.path.basename(f"{book.output}_{trim}.pdf").replace('"', "")
+        self.reply(200, data, "application/pdf", {"ETag": etag, "X-Render": how,
+                                                  "Content-Disposition": f'inline; filename="{name}"'})
+
+    def reply(self, code, body, ctype="text/plain; charset=utf-8", headers=None):
+        body = body.encode() if isinstance(body, str) else body
+        try:
+            self.send_response(code)
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            if code != 304:
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if code != 304:
+                self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass   # the client gave up; the PDF stays cached for next time
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service, host="127.0.0.1", port=8765, socket_path=None):
+    if socket_path:
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.remove(socket_path)   # left behind by a previous run
+        server = UnixHTTPServer(socket_path, Handler)
+    else:
+        server = ThreadingHTTPServer((host, port), Handler)
+    server.service = service
+    return server
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Serve Spider Quest books on demand from a warm renderer.")
+    ap.add_argument("--host", default="127.0.0.1", help="interface to listen on")
+    ap.add_argument("--port", type=int, default=8765, help="TCP port")
+    ap.add_argument("--socket", help="listen on this Unix socket instead of TCP")
+    ap.add_argument("--jobs", type=int, default=1, help="render pages in N worker processes (0 = one per CPU)")
+    ap.add_argument("--cache-dir", default=bsq.CACHE_DIR, help="page cache shared with build_spider_quest.py")
+    ap.add_argument("--no-cache", action="store_true", help="don't use the on-disk page cache")
+    ap.add_argument("--cache-mb", type=int, default=256, help="memory for finished PDFs kept for repeat requests")
+    args = ap.parse_args()
+
+    fonts = bsq.font_report()
+    print("Fonts:", ", ".join(f"{k}={v}" for k, v in fonts.items()))
+    service = RenderService(jobs=args.jobs or os.cpu_count() or 1, cache_dir=None if args.no_cache else args.cache_dir,
+                            cache_bytes=args.cache_mb << 20)
+    server = make_server(service, args.host, args.port, args.socket)
+    print(f"Serving on {'unix:' + args.socket if args.socket else f'http://{args.host}:{args.port}'} (Ctrl-C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+    finally:
+        server.server_close()
+        service.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
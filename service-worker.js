@@ -1,4 +1,5 @@
-const CACHE_NAME = 'spider-quest-v2';
+const CACHE_NAME = 'spider-quest-v3';
+const BOOKS_CACHE = 'spider-quest-books';
 const ASSETS = [
   './',
   './index.html',
@@ -6,18 +7,101 @@ const ASSETS = [
   './script.js',
   './manifest.json',
   './icon-192.png',
-  './icon-512.png',
-  // Raw PDFs (works only if NOT in Git LFS)
-  './books/Spiders_Eight_Legs_of_Awesome_8p5x8p5.pdf',
-  './books/Spiders_Eight_Legs_of_Awesome_8x10.pdf'
+  './icon-512.png'
 ];
+// Written by build_spider_quest.py: { version, assets: [{ url, sha256, bytes }] }.
+// Books are cached lazily on first use, keyed by content hash, so a deploy
+// only refetches the books that actually changed.
+const BOOKS_MANIFEST = new URL('./books/precache-manifest.json', self.location).href;
+
+// The last manifest fetched is kept in BOOKS_CACHE too, so a worker that
+// starts offline still knows which books it holds.
+let booksIndex = null;   // { fresh, index: absolute URL -> sha256 }
+async function readBooksManifest() {
+  const cache = await caches.open(BOOKS_CACHE);
+  try {
+    const resp = await fetch(BOOKS_MANIFEST, { cache: 'no-cache' });
+    if (resp.ok) {
+      const manifest = await resp.clone().json();
+      if (manifest.assets && manifest.assets.length) {
+        await cache.put(BOOKS_MANIFEST, resp);
+        return { fresh: true, manifest };
+      }
+    }
+  } catch (err) {
+    // offline: use the saved copy
+  }
+  const saved = await cache.match(BOOKS_MANIFEST);
+  return { fresh: false, manifest: saved ? await saved.json() : { assets: [] } };
+}
+function loadBooksIndex(refresh) {
+  if (!booksIndex || refresh) {
+    booksIndex = readBooksManifest().then(({ fresh, manifest }) => ({
+      fresh,
+      index: new Map(manifest.assets.map(a => [new URL(a.url, BOOKS_MANIFEST).href, a.sha256])),
+    }));
+  }
+  return booksIndex;
+}
+const versioned = (url, hash) => `${url}?sha256=${hash}`;
+
+async function pruneBooks() {
+  // Only a manifest just fetched from the server says what is current.
+  // Offline, or with no manifest deployed, every cached book stays.
+  const { fresh, index } = await loadBooksIndex(true);
+  if (!fresh || !index.size) return;
+  const current = new Set([...index].map(([url, hash]) => versioned(url, hash)));
+  const cache = await caches.open(BOOKS_CACHE);
+  const keys = await cache.keys();
+  const cached = new Set(keys.map(req => req.url));
+  for (const req of keys) {
+    if (req.url === BOOKS_MANIFEST || current.has(req.url)) continue;
+    // A superseded version stays until the current one has been cached.
+    const url = req.url.split('?')[0];
+    if (index.has(url) && !cached.has(versioned(url, index.get(url)))) continue;
+    await cache.delete(req);
+  }
+}
+
+async function fetchBook(request, url, hash) {
+  // hash: the current version's, if the manifest lists this book.
+  const cache = await caches.open(BOOKS_CACHE);
+  const key = hash && versioned(url, hash);
+  const hit = key && await cache.match(key);
+  if (hit) return hit;
+  try {
+    const resp = await fetch(request);
+    if (key && resp.ok && resp.status === 200) await cache.put(key, resp.clone());
+    return resp;
+  } catch (err) {
+    // Offline: any version we have beats none.
+    const old = await cache.match(url, { ignoreSearch: true });
+    if (old) return old;
+    throw err;
+  }
+}
 
 self.addEventListener('install', (e) => {
   e.waitUntil(caches.open(CACHE_NAME).then(cache => cache.addAll(ASSETS)));
 });
 self.addEventListener('activate', (e) => {
-  e.waitUntil(self.clients.claim());
+  e.waitUntil((async () => {
+    const keep = [CACHE_NAME, BOOKS_CACHE];
+    for (const name of await caches.keys()) {
+      if (!keep.includes(name)) await caches.delete(name);
+    }
+    await pruneBooks();
+    await self.clients.claim();
+  })());
 });
 self.addEventListener('fetch', (e) => {
+  const url = e.request.url.split('?')[0];
+  if (e.request.method !== 'GET' || url === BOOKS_MANIFEST) return;
+  // A page load picks up a new deploy's manifest and drops superseded books.
+  if (e.request.mode === 'navigate') e.waitUntil(pruneBooks());
+  if (url.startsWith(new URL('./books/', self.location).href)) {
+    e.respondWith(loadBooksIndex().then(({ index }) => fetchBook(e.request, url, index.get(url))));
+    return;
+  }
   e.respondWith(caches.match(e.request).then(resp => resp || fetch(e.request)));
 });